@@ -1,9 +1,11 @@
 import sys
 
-if len(sys.argv) == 1:
-    from .shellMenu import main
-    main()
+# Guarded so that spawned worker processes (--jobs) do not re-run the CLI
+if __name__ == "__main__":
+    if len(sys.argv) == 1:
+        from .shellMenu import main
+        main()
 
-else:
-    from .cli import main
-    main()
+    else:
+        from .cli import main
+        main()
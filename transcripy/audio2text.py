@@ -1,9 +1,27 @@
 import json
-from typing import List, Optional
+import os
+import subprocess
+import time
+from typing import Any, Dict, List, Optional, Tuple, TypedDict
+import numpy as np
+import torch
 import whisper
 from whisper import Whisper
+from whisper.audio import HOP_LENGTH, N_FRAMES, N_SAMPLES, SAMPLE_RATE
+from whisper.tokenizer import Tokenizer, get_tokenizer
+from tqdm import tqdm
 
-from .helper import MultiFileHandler, WhisperSegment
+from .helper import ManifestEntry, MultiFileHandler, Region, WavReader, WhisperSegment, _call_worker, energy_vad, merge_regions, pack_regions, read_rttm, split_at_pauses
+
+# fallback of whisper.transcribe: windows are decoded again with the next temperature
+TEMPERATURES = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOGPROB_THRESHOLD = -1.0
+NO_SPEECH_THRESHOLD = 0.6
+# seconds per timestamp token
+TIMESTAMP_PRECISION = 0.02
+# seconds added before and after every speech region
+REGION_PADDING = 0.3
 
 
 # def transcribe(model: Whisper, path: str, language: Optional[str] = None) -> DecodingResult:
@@ -24,25 +42,383 @@ from .helper import MultiFileHandler, WhisperSegment
 #     return result
 
 
+def split_timestamps(tokens: List[int], timestamp_begin: int, duration: float) -> List[Tuple[float, float, List[int]]]:
+    '''
+    Splits the tokens of one decoded window at consecutive timestamp tokens, like whisper.transcribe.
+    Returns (start, end, tokens) relative to the window. As windows are not re-decoded from the last timestamp,
+    an unfinished last segment ends with the window
+    '''
+    is_timestamp = [t >= timestamp_begin for t in tokens]
+    consecutive = [i for i in range(1, len(tokens)) if is_timestamp[i-1] and is_timestamp[i]]
+    if len(consecutive) == 0:
+        timestamps = [t for t in tokens if t >= timestamp_begin]
+        if len(timestamps) > 0 and timestamps[-1] != timestamp_begin:
+            duration = (timestamps[-1]-timestamp_begin)*TIMESTAMP_PRECISION
+        return [(0.0, duration, tokens)] if len(tokens) > 0 else []
+    pieces: List[Tuple[float, float, List[int]]] = []
+    last = 0
+    for current in consecutive+[len(tokens)]:
+        sliced = tokens[last:current]
+        last = current
+        if not any(t < timestamp_begin for t in sliced):
+            continue
+        start = (sliced[0]-timestamp_begin)*TIMESTAMP_PRECISION if sliced[0] >= timestamp_begin else 0.0
+        end = (sliced[-1]-timestamp_begin)*TIMESTAMP_PRECISION if sliced[-1] >= timestamp_begin else duration
+        pieces.append((start, max(start, end), sliced))
+    return pieces
+
+
+def load_audio(path: str, start: float = 0.0, end: Optional[float] = None) -> np.ndarray:
+    '''
+    Range [start, end) in seconds of an audio file as 16 kHz mono, decoded like whisper.load_audio
+    '''
+    if start == 0 and end is None:
+        return whisper.load_audio(path)
+    cmd = ["ffmpeg", "-nostdin", "-threads", "0", "-ss", f"{start:.3f}"]
+    if end is not None:
+        cmd += ["-t", f"{end-start:.3f}"]
+    cmd += ["-i", path, "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "-"]
+    try:
+        out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+class TimeMap:
+    '''
+    Maps times of audio concatenated from regions back to the original file
+    '''
+
+    def __init__(self, regions: List[Region]) -> None:
+        self.starts = np.array([start for start, _end in regions])
+        self.lengths = np.array([end-start for start, end in regions])
+        self.offsets = np.concatenate([[0.0], np.cumsum(self.lengths)[:-1]])
+
+    @property
+    def duration(self) -> float:
+        return float(np.sum(self.lengths))
+
+    def __call__(self, t: float, end: bool = False) -> float:
+        # an end on the border of two regions belongs to the earlier one
+        idx = int(np.searchsorted(self.offsets, t, side="left" if end else "right"))-1
+        idx = min(max(idx, 0), len(self.starts)-1)
+        return float(self.starts[idx]+min(max(t-self.offsets[idx], 0.0), self.lengths[idx]))
+
+    def clip(self, audio: np.ndarray, offset: float = 0.0) -> np.ndarray:
+        '''
+        The regions of 16 kHz audio starting at offset seconds, concatenated
+        '''
+        return np.concatenate([audio[int(round((start-offset)*SAMPLE_RATE)):int(round((start-offset+length)*SAMPLE_RATE))]
+                               for start, length in zip(self.starts, self.lengths)])
+
+
+class MelWindow(TypedDict):
+    file: str
+    index: int
+    seek: int
+    duration: float
+    time_map: TimeMap
+    mel: torch.Tensor
+
+
+class BatchedFile(TypedDict):
+    output_file: str
+    language: str
+    windows: int
+    segments: Dict[int, List[WhisperSegment]]
+
+
 class MultiTranscriber(MultiFileHandler):
-    def __init__(self, data_path: str, verbose: bool = False, model: str = "medium", english_only: bool = False, forceLanguage: Optional[str] = None) -> None:
+    model_attributes = ["model"]
+
+    def __init__(self, data_path: str, verbose: bool = False, model: str = "medium", english_only: bool = False, forceLanguage: Optional[str] = None, jobs: int = 1, word_timestamps: bool = False, batch_size: int = 1, speech_only: bool = False, part_minutes: float = 0) -> None:
         super().__init__(data_path, verbose, "raw_audio_voices",
-                         "text", "json", ["wav"])
+                         "text", "json", ["wav"], jobs=jobs)
         if english_only:
             model = model+".en"
-        self.model: Whisper = whisper.load_model(model)
+        self.model_name = model
+        self.model: Optional[Whisper] = None
         self.forceLanguage = forceLanguage
+        self.word_timestamps = word_timestamps
+        # windows of all files decoded at once. 1 transcribes each file with model.transcribe
+        self.batch_size = batch_size
+        # transcribe only regions of the diarization (or of an energy VAD without diarization)
+        self.speech_only = speech_only
+        # long files are split into parts of about part_seconds at pauses, transcribed by the jobs worker processes
+        self.part_seconds = part_minutes*60
         self.verbose = verbose
+        if batch_size > 1 and word_timestamps:
+            print("Word timestamps are not supported with batches. Transcribing each file separately...")
+            self.batch_size = 1
 
-    def handler(self, input_file: str, output_file: str, file_idx: int) -> None:
-        if self.forceLanguage is None:
-            result = self.model.transcribe(input_file)
+    def load_model(self) -> None:
+        self.model = whisper.load_model(self.model_name)
+
+    def params(self) -> Dict[str, Any]:
+        params: Dict[str, Any] = {"model": self.model_name, "language": self.forceLanguage}
+        if self.word_timestamps:
+            params["word_timestamps"] = True
+        if self.batch_size > 1:
+            # windows are decoded without the text of the previous window
+            params["batched"] = True
+        if self.speech_only:
+            params["speech_only"] = True
+        if self.splits_files():
+            # parts are transcribed without the text of the previous part
+            params["part_minutes"] = self.part_seconds/60
+        return params
+
+    def splits_files(self) -> bool:
+        return self.part_seconds > 0 and self.jobs > 1 and self.batch_size <= 1
+
+    def dependencies(self, input_file: str) -> List[str]:
+        if self.speech_only:
+            return [self.diarization_path(input_file)]
+        return []
+
+    def diarization_path(self, input_file: str) -> str:
+        return input_file.replace("raw_audio_voices", "diarization").replace(".wav", ".rttm")
+
+    def speech_regions(self, input_file: str) -> Optional[List[Region]]:
+        '''
+        Merged turns of the diarization, if the file has one
+        '''
+        if not os.path.isfile(self.diarization_path(input_file)):
+            return None
+        _uri, turns = read_rttm(self.diarization_path(input_file), load_overwrite=False)
+        return merge_regions([(t["start"], t["start"]+t["duration"]) for t in turns])
+
+    def speech_chunks(self, input_file: str, audio: np.ndarray, offset: float = 0.0) -> List[List[Region]]:
+        '''
+        Padded speech regions of 16 kHz audio starting at offset seconds, grouped into chunks of at most 30 seconds
+        '''
+        duration = len(audio)/SAMPLE_RATE
+        turns = self.speech_regions(input_file)
+        if turns is not None:
+            regions = [(start-offset, end-offset) for start, end in turns]
         else:
-            result = self.model.transcribe(
-                input_file, verbose=self.verbose, language=self.forceLanguage)
-        segments: List[WhisperSegment] = result["segments"]
-        language = result["language"]
-        text = result["text"]
+            regions = energy_vad(audio, SAMPLE_RATE)
+        regions = merge_regions(regions, REGION_PADDING, duration)
+        if self.verbose:
+            speech = sum(end-start for start, end in regions)
+            print(f"Transcribing {speech:.0f}s of speech in {duration:.0f}s ({input_file})")
+        return [[(start+offset, end+offset) for start, end in chunk]
+                for chunk in pack_regions(regions, N_FRAMES*HOP_LENGTH/SAMPLE_RATE)]
+
+    def transcribe_options(self) -> Dict[str, Any]:
+        options: Dict[str, Any] = {}
+        if self.forceLanguage is not None:
+            options["verbose"] = self.verbose
+            options["language"] = self.forceLanguage
+        if self.word_timestamps:
+            options["word_timestamps"] = True
+        return options
+
+    def handler(self, input_file: str, output_file: str, file_idx: int) -> None:
+        segments, language, _text = self.transcribe_part(input_file, self.transcribe_options())
+        self.write_text(output_file, segments, language)
+
+    def write_text(self, output_file: str, segments: List[WhisperSegment], language: str) -> None:
+        for idx, segment in enumerate(segments):
+            segment["id"] = idx
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
         with open(output_file, 'w') as f:
             json.dump({"segments": segments, "language": language,
-                      "text": text}, f, indent=4)
+                      "text": "".join(s["text"] for s in segments)}, f, indent=4)
+
+    def transcribe_part(self, input_file: str, options: Dict[str, Any], start: float = 0.0, end: Optional[float] = None) -> Tuple[List[WhisperSegment], str, str]:
+        '''
+        Transcribes [start, end) of a file in seconds, or only its speech chunks one after another
+        with the text of the previous chunk as prompt. Timestamps are relative to the file
+        '''
+        assert self.model is not None
+        audio = load_audio(input_file, start, end)
+        if self.speech_only:
+            chunks = self.speech_chunks(input_file, audio, start)
+        else:
+            chunks = [[(start, start+len(audio)/SAMPLE_RATE)]]
+        segments: List[WhisperSegment] = []
+        language = self.forceLanguage or "en"
+        prompt: Optional[str] = None
+        for chunk in chunks:
+            time_map = TimeMap(chunk)
+            result = self.model.transcribe(time_map.clip(audio, start), initial_prompt=prompt, **options)
+            # the language is detected in the first chunk only
+            language = result["language"]
+            options = {**options, "language": language}
+            prompt = result["text"]
+            for segment in result["segments"]:
+                segment["id"] = len(segments)
+                segment["seek"] = int(round(time_map(segment["seek"]*HOP_LENGTH/SAMPLE_RATE)*SAMPLE_RATE/HOP_LENGTH))
+                segment["start"] = time_map(segment["start"])
+                segment["end"] = time_map(segment["end"], end=True)
+                for word in segment.get("words", []):
+                    word["start"] = time_map(word["start"])
+                    word["end"] = time_map(word["end"], end=True)
+                segments.append(segment)
+        return segments, language, "".join(s["text"] for s in segments)
+
+    def run(self):
+        if self.splits_files():
+            self.run_parts()
+            return
+        if self.batch_size <= 1:
+            super().run()
+            return
+        files, entries = self.pending()
+        if len(files) == 0:
+            return
+        self.ensure_model()
+        assert self.model is not None
+        tokenizer = get_tokenizer(self.model.is_multilingual)
+        queues: Dict[str, List[MelWindow]] = {}
+        batched: Dict[str, BatchedFile] = {}
+        audio_seconds = 0.0
+        start = time.time()
+        try:
+            for file in tqdm(files):
+                windows, language, duration = self.mel_windows(file)
+                batched[file] = {"output_file": self.output_path(file), "language": language,
+                                 "windows": len(windows), "segments": {}}
+                audio_seconds += duration
+                queue = queues.setdefault(language, [])
+                queue.extend(windows)
+                while len(queue) >= self.batch_size:
+                    self.decode_batch(queue[:self.batch_size], language, tokenizer, batched)
+                    del queue[:self.batch_size]
+                self.write_finished(batched, entries)
+            for language, queue in queues.items():
+                if len(queue) > 0:
+                    self.decode_batch(queue, language, tokenizer, batched)
+            self.write_finished(batched, entries)
+        finally:
+            if self.manifest is not None:
+                self.manifest.save()
+        elapsed = time.time()-start
+        print(f"Transcribed {audio_seconds/3600:.2f} audio-hours in {elapsed/3600:.2f} hours "
+              f"({audio_seconds/max(elapsed, 1e-9):.1f} audio-hours/hour)")
+
+    def run_parts(self):
+        '''
+        Transcribes the parts of all files in the worker pool, and stitches the parts of a file as soon as all are done
+        '''
+        files, entries = self.pending()
+        if len(files) == 0:
+            return
+        tasks: List[Tuple[str, Tuple[Any, ...]]] = []
+        task_files: List[str] = []
+        part_count: Dict[str, int] = {}
+        for file in files:
+            input_file = os.path.join(self.input_dir, file)
+            turns = self.speech_regions(input_file) or []
+            pauses = [(a[1], b[0]) for a, b in zip(turns[:-1], turns[1:])]
+            parts = split_at_pauses(WavReader(input_file), self.part_seconds, pauses)
+            part_count[file] = len(parts)
+            if self.verbose:
+                print(f"{file}: {len(parts)} parts")
+            for idx, (start, end) in enumerate(parts):
+                # the last part is read to the end of the file
+                tasks.append(("transcribe_part", (input_file, self.transcribe_options(), start,
+                                                  end if idx < len(parts)-1 else None)))
+                task_files.append(file)
+        results: Dict[str, List[Optional[Tuple[List[WhisperSegment], str, str]]]] = {file: [] for file in files}
+        try:
+            with self.pool() as pool:
+                for file, (result, error) in tqdm(zip(task_files, pool.imap(_call_worker, tasks)), total=len(tasks)):
+                    if error is not None:
+                        print(f"Error processing {os.path.join(self.input_dir, file)}\n{error}")
+                    results[file].append(result)
+                    if len(results[file]) < part_count[file]:
+                        continue
+                    parts = results.pop(file)
+                    if any(part is None for part in parts):
+                        continue
+                    segments = [segment for part in parts if part is not None for segment in part[0]]
+                    self.write_text(self.output_path(file), segments, parts[0][1] if parts[0] is not None else "en")
+                    self.record(file, entries[file])
+        finally:
+            if self.manifest is not None:
+                self.manifest.save()
+
+    def mel_windows(self, file: str) -> Tuple[List[MelWindow], str, float]:
+        '''
+        30 second log-Mel windows of a file, its language and its duration in seconds
+        '''
+        assert self.model is not None
+        input_file = os.path.join(self.input_dir, file)
+        audio = whisper.load_audio(input_file)
+        windows: List[MelWindow] = []
+        if self.speech_only:
+            for idx, chunk in enumerate(self.speech_chunks(input_file, audio)):
+                time_map = TimeMap(chunk)
+                # padded with silence like whisper.transcribe
+                mel = whisper.log_mel_spectrogram(time_map.clip(audio), self.model.dims.n_mels, padding=N_SAMPLES)
+                windows.append({"file": file, "index": idx, "seek": int(round(chunk[0][0]*SAMPLE_RATE/HOP_LENGTH)),
+                                "duration": time_map.duration, "time_map": time_map,
+                                "mel": mel[:, :N_FRAMES]})
+        else:
+            mel = whisper.log_mel_spectrogram(audio, self.model.dims.n_mels, padding=N_SAMPLES)
+            frames = mel.shape[-1]-N_FRAMES
+            for idx, seek in enumerate(range(0, frames, N_FRAMES)):
+                duration = min(N_FRAMES, frames-seek)*HOP_LENGTH/SAMPLE_RATE
+                offset = seek*HOP_LENGTH/SAMPLE_RATE
+                windows.append({"file": file, "index": idx, "seek": seek, "duration": duration,
+                                "time_map": TimeMap([(offset, offset+duration)]),
+                                "mel": mel[:, seek:seek+N_FRAMES]})
+        if self.forceLanguage is not None:
+            language = self.forceLanguage
+        elif not self.model.is_multilingual:
+            language = "en"
+        elif len(windows) == 0:
+            language = "en"
+        else:
+            _, probs = self.model.detect_language(windows[0]["mel"].to(self.model.device))
+            language = max(probs, key=probs.get)
+            if self.verbose:
+                print(f"Detected language of {file}: {language}")
+        return windows, language, len(audio)/SAMPLE_RATE
+
+    def decode_batch(self, windows: List[MelWindow], language: str, tokenizer: Tokenizer, batched: Dict[str, BatchedFile]) -> None:
+        '''
+        Decodes windows of one language in a single batch, and decodes the failed windows again with higher temperatures
+        '''
+        assert self.model is not None
+        mel = torch.stack([w["mel"] for w in windows]).to(self.model.device)
+        fp16 = self.model.device.type != "cpu"
+        results: List[Any] = [None]*len(windows)
+        todo = list(range(len(windows)))
+        for temperature in TEMPERATURES:
+            options = whisper.DecodingOptions(language=language, temperature=temperature, fp16=fp16)
+            decoded = whisper.decode(self.model, mel[todo], options)
+            retry = []
+            for idx, result in zip(todo, decoded):
+                results[idx] = result
+                silent = result.no_speech_prob > NO_SPEECH_THRESHOLD
+                if not silent and (result.compression_ratio > COMPRESSION_RATIO_THRESHOLD or result.avg_logprob < LOGPROB_THRESHOLD):
+                    retry.append(idx)
+            todo = retry
+            if len(todo) == 0:
+                break
+        for window, result in zip(windows, results):
+            segments: List[WhisperSegment] = []
+            silent = result.no_speech_prob > NO_SPEECH_THRESHOLD and result.avg_logprob < LOGPROB_THRESHOLD
+            if not silent:
+                time_map = window["time_map"]
+                for start, end, tokens in split_timestamps(list(result.tokens), tokenizer.timestamp_begin, window["duration"]):
+                    segments.append({"id": 0, "seek": window["seek"], "start": time_map(start), "end": time_map(end, end=True),
+                                     "text": tokenizer.decode([t for t in tokens if t < tokenizer.eot]),
+                                     "tokens": tokens, "temperature": result.temperature,
+                                     "avg_logprob": result.avg_logprob, "compression_ratio": result.compression_ratio,
+                                     "no_speech_prob": result.no_speech_prob})
+            batched[window["file"]]["segments"][window["index"]] = segments
+
+    def write_finished(self, batched: Dict[str, BatchedFile], entries: Dict[str, Optional[ManifestEntry]]) -> None:
+        '''
+        Writes the files whose windows are all decoded
+        '''
+        for file in [f for f, b in batched.items() if len(b["segments"]) == b["windows"]]:
+            b = batched.pop(file)
+            segments = [s for idx in range(b["windows"]) for s in b["segments"][idx]]
+            self.write_text(b["output_file"], segments, b["language"])
+            self.record(file, entries[file])
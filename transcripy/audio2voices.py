@@ -1,8 +1,24 @@
 from pyannote.audio import Pipeline
+from pyannote.audio.pipelines.speaker_verification import PretrainedSpeakerEmbedding
 import os
-from typing import Any, TypedDict, Tuple
+from math import gcd
+from typing import Any, Dict, List, Optional, TypedDict, Tuple
+import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+from scipy.signal import resample_poly
+from scipy.spatial.distance import cdist
 
-from .helper import MultiFileHandler, read_rttm
+from .helper import MultiFileHandler, RTTMLine, WavReader, pcm_to_float, read_rttm
+
+# seconds shared by consecutive windows. Turns of the overlap are taken from the earlier window up to its middle
+WINDOW_OVERLAP = 30.0
+# seconds of the longest turns of a speaker embedded per window
+EMBEDDING_SECONDS = 30.0
+# cosine distance below which a speaker of a window is a speaker of the earlier windows
+SPEAKER_THRESHOLD = 0.5
+# part of the speech of a speaker in the overlap, which has to match a speaker of the previous window to be the same speaker
+OVERLAP_AGREEMENT = 0.5
 
 
 class DiarizationTurn(TypedDict):
@@ -13,14 +29,110 @@ class DiarizationTurn(TypedDict):
 DiarizationTrack = Tuple[DiarizationTurn, Any, str]
 
 
+def overlap_seconds(a: List[RTTMLine], b: List[RTTMLine], t1: float, t2: float) -> float:
+    '''
+    Seconds within [t1, t2) in which turns a and turns b overlap
+    '''
+    total = 0.0
+    for x in a:
+        for y in b:
+            start = max(x["start"], y["start"], t1)
+            end = min(x["start"]+x["duration"], y["start"]+y["duration"], t2)
+            total += max(0.0, end-start)
+    return total
+
+
+def agreed_speakers(speakers: List[List[RTTMLine]], previous: Dict[int, List[RTTMLine]], t1: float, t2: float) -> Dict[int, int]:
+    '''
+    Maps speakers (turns per speaker) to the global speaker of the previous window they share most of
+    their speech within the overlap [t1, t2) with
+    '''
+    agreed: Dict[int, int] = {}
+    for idx, turns in enumerate(speakers):
+        speech = sum(max(0.0, min(t["start"]+t["duration"], t2)-max(t["start"], t1)) for t in turns)
+        if speech < 1.0 or len(previous) == 0:
+            continue
+        shared = {speaker: overlap_seconds(turns, other, t1, t2) for speaker, other in previous.items()}
+        best = max(shared, key=lambda speaker: shared[speaker])
+        if shared[best] >= OVERLAP_AGREEMENT*speech:
+            agreed[idx] = best
+    return agreed
+
+
+class SpeakerCentroids:
+    '''
+    Speakers of all windows so far, as the weighted sum of their normalized embeddings
+    '''
+
+    def __init__(self, threshold: float = SPEAKER_THRESHOLD) -> None:
+        self.threshold = threshold
+        self.sums: List[np.ndarray] = []
+
+    def assign(self, embeddings: np.ndarray, weights: List[float], agreed: Dict[int, int]) -> List[int]:
+        '''
+        Global speaker of each speaker of a window. Speakers of one window are never merged.
+        agreed maps speakers to the global speaker they share the overlap with the previous window with
+        '''
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        # pyannote returns NaN for too short speech
+        valid = np.isfinite(norms[:, 0]) & (norms[:, 0] > 0)
+        normalized = np.where(valid[:, None], embeddings/np.where(valid[:, None], norms, 1), 0)
+        labels = [-1]*len(embeddings)
+        if len(self.sums) > 0:
+            centroids = np.stack(self.sums)
+            centroids = centroids/np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-10)
+            cost = cdist(normalized, centroids, metric="cosine")
+            cost[~valid] = np.inf
+            cost = np.nan_to_num(cost, nan=np.inf)
+            for local, speaker in agreed.items():
+                cost[local, speaker] = -1.0
+            rows, cols = linear_sum_assignment(np.minimum(cost, 2.0))
+            for row, col in zip(rows, cols):
+                if cost[row, col] < self.threshold:
+                    labels[row] = int(col)
+        for idx in range(len(labels)):
+            if labels[idx] < 0:
+                labels[idx] = len(self.sums)
+                self.sums.append(np.zeros(embeddings.shape[1]))
+            self.sums[labels[idx]] += normalized[idx]*weights[idx]
+        return labels
+
+
 class MultiDetector(MultiFileHandler):
-    def __init__(self, data_path: str, verbose: bool = False, model: str = "pyannote/speaker-diarization") -> None:
+    model_attributes = ["pipeline", "embedding"]
+
+    def __init__(self, data_path: str, verbose: bool = False, model: str = "pyannote/speaker-diarization", jobs: int = 1, window_minutes: float = 0, embedding_model: str = "speechbrain/spkrec-ecapa-voxceleb") -> None:
         super().__init__(data_path, verbose, "raw_audio_voices",
-                         "diarization", "rttm", ["wav"])
-        self.pipeline = Pipeline.from_pretrained(model)
+                         "diarization", "rttm", ["wav"], jobs=jobs)
+        self.model_name = model
+        self.pipeline: Optional[Pipeline] = None
+        # long files are diarized in overlapping windows of window_seconds, so memory does not grow with their length
+        self.window_seconds = window_minutes*60
+        self.embedding_model = embedding_model
+        self.embedding: Optional[PretrainedSpeakerEmbedding] = None
+
+    def load_model(self) -> None:
+        self.pipeline = Pipeline.from_pretrained(self.model_name)
+        if self.window_seconds > 0:
+            self.embedding = PretrainedSpeakerEmbedding(self.embedding_model)
+
+    def params(self) -> Dict[str, Any]:
+        params: Dict[str, Any] = {"model": self.model_name}
+        if self.window_seconds > 0:
+            params["window_minutes"] = self.window_seconds/60
+            params["embedding_model"] = self.embedding_model
+        return params
 
     def handler(self, input_file: str, output_file: str, file_idx: int) -> None:
+        assert self.pipeline is not None
         uri, audio = os.path.split(input_file)
+        if self.window_seconds > 0:
+            turns = self.diarize_windows(input_file, audio.replace(" ", "_"))
+            with open(output_file, "w") as rttm:
+                for turn in turns:
+                    rttm.write(f"SPEAKER {audio.replace(' ', '_')} 1 {turn['start']:.3f} {turn['duration']:.3f} "
+                               f"<NA> <NA> {turn['speaker']} <NA> <NA>\n")
+            return
         file_identifier = {'uri': audio.replace(" ", "_"), 'audio': input_file}
         diarization = self.pipeline(file_identifier)
         # with open(output_file, 'w') as f:
@@ -36,3 +148,93 @@ class MultiDetector(MultiFileHandler):
         # overwrite_path = output_file.replace(".rttm", ".json")
         # with open(overwrite_path, "w") as f:
         #     json.dump(overwrite, f, indent=4)
+
+    def diarize_window(self, audio: np.ndarray, sample_rate: int, uri: str, offset: float) -> Dict[str, List[RTTMLine]]:
+        '''
+        Turns of each speaker of a window of mono audio starting at offset seconds
+        '''
+        assert self.pipeline is not None
+        annotation = self.pipeline({"waveform": torch.from_numpy(audio[None]), "sample_rate": sample_rate, "uri": uri})
+        speakers: Dict[str, List[RTTMLine]] = {}
+        for segment, _track, label in annotation.itertracks(yield_label=True):
+            speakers.setdefault(label, []).append(
+                {"start": offset+segment.start, "duration": segment.duration, "speaker": label})
+        return speakers
+
+    def embed_speakers(self, audio: np.ndarray, sample_rate: int, offset: float, speakers: Dict[str, List[RTTMLine]]) -> np.ndarray:
+        '''
+        One embedding per speaker of a window, of up to EMBEDDING_SECONDS of its longest turns
+        '''
+        assert self.embedding is not None
+        crops: List[np.ndarray] = []
+        for turns in speakers.values():
+            parts: List[np.ndarray] = []
+            length = 0
+            for turn in sorted(turns, key=lambda t: t["duration"], reverse=True):
+                f1 = int((turn["start"]-offset)*sample_rate)
+                part = audio[f1:f1+min(int(turn["duration"]*sample_rate), int(EMBEDDING_SECONDS*sample_rate)-length)]
+                parts.append(part)
+                length += len(part)
+                if length >= EMBEDDING_SECONDS*sample_rate:
+                    break
+            crop = np.concatenate(parts)
+            if sample_rate != self.embedding.sample_rate:
+                divisor = gcd(sample_rate, self.embedding.sample_rate)
+                crop = resample_poly(crop, self.embedding.sample_rate//divisor, sample_rate//divisor).astype(np.float32)
+            crops.append(crop)
+        waveforms = torch.zeros((len(crops), 1, max(len(c) for c in crops)))
+        masks = torch.zeros((len(crops), waveforms.shape[-1]))
+        for idx, crop in enumerate(crops):
+            waveforms[idx, 0, :len(crop)] = torch.from_numpy(crop)
+            masks[idx, :len(crop)] = 1.0
+        return np.asarray(self.embedding(waveforms, masks=masks))
+
+    def diarize_windows(self, input_file: str, uri: str) -> List[RTTMLine]:
+        '''
+        Diarizes overlapping windows and labels their speakers globally by their embeddings (see SpeakerCentroids).
+        Only one window is in memory at once
+        '''
+        reader = WavReader(input_file)
+        rate = reader.frame_rate
+        window = int(self.window_seconds*rate)
+        overlap = min(int(WINDOW_OVERLAP*rate), window//2)
+        centroids = SpeakerCentroids()
+        stitched: List[RTTMLine] = []
+        # turns of the previous window per global speaker
+        previous: Dict[int, List[RTTMLine]] = {}
+        f1 = 0
+        while True:
+            f2 = min(f1+window, reader.frames)
+            offset = f1/rate
+            audio = pcm_to_float(reader.frame_samples(f1, f2), reader.sample_width).mean(axis=1)
+            speakers = self.diarize_window(audio, rate, uri, offset)
+            names = list(speakers)
+            labels: List[int] = []
+            if len(names) > 0:
+                agreed = agreed_speakers([speakers[name] for name in names], previous, offset, offset+overlap/rate)
+                weights = [sum(t["duration"] for t in speakers[name]) for name in names]
+                labels = centroids.assign(self.embed_speakers(audio, rate, offset, speakers), weights, agreed)
+            del audio
+            current = sorted([{"start": t["start"], "duration": t["duration"], "speaker": f"SPEAKER_{labels[idx]:02d}"}
+                              for idx, name in enumerate(names) for t in speakers[name]], key=lambda t: t["start"])
+            # earlier turns are taken up to the middle of the overlap, later turns after it
+            cut = offset+overlap/rate/2 if f1 > 0 else 0.0
+            stitched = [t for t in stitched if t["start"] < cut]
+            for turn in stitched:
+                if turn["start"]+turn["duration"] > cut:
+                    turn["duration"] = cut-turn["start"]
+            for turn in current:
+                end = turn["start"]+turn["duration"]
+                if end <= cut:
+                    continue
+                start = max(turn["start"], cut)
+                stitched.append({"start": start, "duration": end-start, "speaker": turn["speaker"]})
+            previous = {}
+            for idx, name in enumerate(names):
+                previous.setdefault(labels[idx], []).extend(speakers[name])
+            if self.verbose:
+                print(f"Window {offset:.0f}s-{f2/rate:.0f}s: {len(names)} speakers, {len(centroids.sums)} in total")
+            if f2 >= reader.frames:
+                break
+            f1 += window-overlap
+        return sorted(stitched, key=lambda t: t["start"])
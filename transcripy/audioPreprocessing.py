@@ -1,12 +1,20 @@
 import os
+import shutil
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 from spleeter.separator import Separator
 from spleeter.audio.adapter import AudioAdapter
 
-from typing import Any, Dict, TypedDict, Tuple, cast
+from typing import Any, Dict, List, Optional, TypedDict, Tuple, cast
+import numpy as np
 
-from .helper import MultiFileHandler
+from .backgroundDetector import BackgroundEstimate, estimate_background, estimate_wav_background
+from .helper import MultiFileHandler, StreamingWavWriter, WavReader, float_to_pcm
+
+# seconds of audio separated at once
+CHUNK_SECONDS = 300.0
+# seconds shared by consecutive chunks, crossfaded to hide the borders of the separation
+OVERLAP_SECONDS = 1.0
 
 
 class DiarizationTurn(TypedDict):
@@ -17,25 +25,150 @@ class DiarizationTurn(TypedDict):
 DiarizationTrack = Tuple[DiarizationTurn, Any, str]
 
 
+class OverlapAddWriter:
+    '''
+    Writes separated chunks, which overlap by overlap frames, into a 16-bit WAV file.
+    The overlaps are crossfaded linearly, only the last overlap is kept in memory
+    '''
+
+    def __init__(self, path: str, channels: int, frame_rate: int, overlap: int) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            # a previous output may be a hardlink of the input (see MultiVoiceExtractor.link_clean)
+            os.remove(path)
+        self.writer = StreamingWavWriter(path, channels, frame_rate, 2)
+        self.channels = channels
+        self.overlap = overlap
+        self.tail = np.zeros((0, channels), dtype=np.float32)
+
+    def append(self, y: np.ndarray) -> None:
+        n = min(len(self.tail), len(y))
+        if n > 0:
+            fade = np.linspace(0, 1, n, endpoint=False, dtype=np.float32)[:, None]
+            y = np.concatenate([self.tail[:n]*(1-fade)+y[:n]*fade, y[n:]])
+        keep = min(self.overlap, len(y))
+        self.write(y[:len(y)-keep])
+        self.tail = y[len(y)-keep:]
+
+    def write(self, y: np.ndarray) -> None:
+        if len(y) > 0:
+            self.writer.write(np.frombuffer(float_to_pcm(y, 2), dtype="<i2").reshape((-1, self.channels)))
+
+    def close(self) -> None:
+        self.write(self.tail)
+        self.writer.close()
+
+
 class MultiVoiceExtractor(MultiFileHandler):
-    def __init__(self, data_path: str, verbose: bool = False, model: str = 'spleeter:2stems', vocals_only: bool = True) -> None:
+    model_attributes = ["separator", "audio_loader"]
+
+    def __init__(self, data_path: str, verbose: bool = False, model: str = 'spleeter:2stems', vocals_only: bool = True, jobs: int = 1, chunk_seconds: float = CHUNK_SECONDS, skip_clean_db: Optional[float] = None) -> None:
         super().__init__(data_path, verbose, "raw_audio",
-                         "raw_audio_voices", "wav")
-        # Using embedded configuration.
+                         "raw_audio_voices", "wav", jobs=jobs)
         self.vocals_only = vocals_only
-        self.separator = Separator(model)
+        self.model_name = model
+        # files are separated in overlapping chunks, so memory does not grow with their length
+        self.chunk_seconds = max(chunk_seconds, 4*OVERLAP_SECONDS)
+        # chunks without music or noise above this level (see estimate_background) are not separated
+        self.skip_clean_db = skip_clean_db
+        self.separator: Optional[Separator] = None
+        self.audio_loader: Optional[AudioAdapter] = None
+
+    def load_model(self) -> None:
+        # Using embedded configuration.
+        self.separator = Separator(self.model_name)
         self.audio_loader = AudioAdapter.default()
 
-    def handler(self, input_file: str, output_file: str, file_idx: int) -> None:
-        waveform, _sample_rate = cast(
-            Tuple[Any, int], self.audio_loader.load(input_file))
-        prediction = cast(
-            Dict[str, Any], self.separator.separate(waveform, input_file))
-        output_dir, output_name = os.path.split(output_file)
+    def params(self) -> Dict[str, Any]:
+        params: Dict[str, Any] = {"model": self.model_name, "vocals_only": self.vocals_only}
+        if self.chunk_seconds != CHUNK_SECONDS:
+            params["chunk_seconds"] = self.chunk_seconds
+        if self.skip_clean_db is not None:
+            params["skip_clean_db"] = self.skip_clean_db
+        return params
+
+    def stem_path(self, input_file: str, output_file: str, instrument: str) -> str:
         if self.vocals_only:
-            voice_only = {"vocals": prediction["vocals"]}
-            self.separator.save_to_file(
-                voice_only, input_file, output_dir, filename_format=output_file)
-        else:
-            self.separator.save_to_file(
-                prediction, input_file, output_dir)
+            return output_file
+        # like Separator.save_to_file
+        name = os.path.splitext(os.path.basename(input_file))[0]
+        return os.path.join(os.path.dirname(output_file), name, f"{instrument}.wav")
+
+    def link_clean(self, input_file: str, output_file: str) -> Optional[List[BackgroundEstimate]]:
+        '''
+        Hardlinks (or copies) a WAV file without music or noise to output_file. Returns its estimates, None if it is not clean.
+        Only files in the output format (16-bit PCM at the sample rate of the separator) are linked, others are converted
+        by the chunks of handler
+        '''
+        if self.skip_clean_db is None or not self.vocals_only or not input_file.lower().endswith(".wav"):
+            return None
+        assert self.separator is not None
+        try:
+            reader = WavReader(input_file)
+        except ValueError:
+            return None
+        if reader.dtype != np.dtype("<i2") or reader.frame_rate != self.separator._sample_rate:
+            return None
+        clean, estimates = estimate_wav_background(reader, self.chunk_seconds, self.skip_clean_db)
+        if not clean:
+            return None
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        try:
+            os.link(input_file, output_file)
+        except OSError:
+            # e.g. another file system
+            shutil.copyfile(input_file, output_file)
+        return estimates
+
+    def handler(self, input_file: str, output_file: str, file_idx: int) -> Optional[Dict[str, Any]]:
+        assert self.separator is not None and self.audio_loader is not None
+        linked = self.link_clean(input_file, output_file)
+        if linked is not None:
+            if self.verbose:
+                print(f"No music or noise. Linked {input_file}")
+            return {"separated": "none", "linked": True, "background": linked}
+        sample_rate = cast(int, self.separator._sample_rate)
+        instruments = cast(List[str], self.separator._params["instrument_list"])
+        chunk = int(self.chunk_seconds*sample_rate)
+        overlap = int(OVERLAP_SECONDS*sample_rate)
+        writers: Dict[str, OverlapAddWriter] = {}
+        estimates: List[BackgroundEstimate] = []
+        offset = 0
+        try:
+            while True:
+                waveform, _sample_rate = cast(Tuple[np.ndarray, int], self.audio_loader.load(
+                    input_file, offset=offset/sample_rate, duration=chunk/sample_rate, sample_rate=sample_rate))
+                if len(waveform) == 0:
+                    break
+                if self.skip_clean_db is not None:
+                    estimates.append(estimate_background(
+                        waveform.mean(axis=1), sample_rate, offset/sample_rate, self.skip_clean_db))
+                if len(estimates) > 0 and estimates[-1]["kind"] == "clean":
+                    # the chunk is passed through as vocals
+                    prediction = {instrument: waveform if instrument == "vocals" else np.zeros_like(waveform)
+                                  for instrument in instruments}
+                else:
+                    prediction = cast(
+                        Dict[str, np.ndarray], self.separator.separate(waveform, input_file))
+                for instrument, y in prediction.items():
+                    if self.vocals_only and instrument != "vocals":
+                        continue
+                    if instrument not in writers:
+                        writers[instrument] = OverlapAddWriter(self.stem_path(
+                            input_file, output_file, instrument), y.shape[1], sample_rate, overlap)
+                    writers[instrument].append(y)
+                # decoders may return a few frames less than requested
+                if len(waveform) < chunk-overlap//2:
+                    break
+                offset += chunk-overlap
+        finally:
+            for writer in writers.values():
+                writer.close()
+        if self.skip_clean_db is None:
+            return None
+        clean = sum(e["kind"] == "clean" for e in estimates)
+        separated = "none" if clean == len(estimates) else "all" if clean == 0 else "partial"
+        if self.verbose:
+            print(f"Separated {len(estimates)-clean} of {len(estimates)} chunks with music or noise")
+        return {"separated": separated, "linked": False, "background": estimates}
@@ -0,0 +1,85 @@
+from typing import List, Tuple, TypedDict
+
+import numpy as np
+from scipy.ndimage import minimum_filter1d, uniform_filter1d
+
+from .helper import WavReader, pcm_to_float
+
+# level of the sustained energy relative to the loud frames, above which music or noise is present
+BACKGROUND_DB = -40.0
+# flatness of the sustained spectrum above which the background is noise instead of music
+NOISE_FLATNESS = 0.3
+# energy of a frequency bin has to last this long to be part of the background. Speech pauses or moves its formants faster
+SUSTAIN_SECONDS = 1.0
+# frequencies above are not analyzed
+MAX_FREQUENCY = 8000
+
+
+class BackgroundEstimate(TypedDict):
+    start: float
+    end: float
+    # "clean", "music" or "noise"
+    kind: str
+    background_db: float
+    flatness: float
+
+
+def power_spectrogram(audio: np.ndarray, sample_rate: int) -> Tuple[np.ndarray, int]:
+    '''
+    Power of frames of about 50 ms with half overlap up to MAX_FREQUENCY, shape [frames, bins], and the hop in samples
+    '''
+    frame = 1 << int(np.ceil(np.log2(0.05*sample_rate)))
+    hop = frame//2
+    bins = min(int(MAX_FREQUENCY*frame/sample_rate), frame//2)+1
+    if len(audio) < frame:
+        return np.zeros((0, bins), dtype=np.float32), hop
+    frames = np.lib.stride_tricks.sliding_window_view(audio.astype(np.float32), frame)[::hop]
+    spectrum = np.fft.rfft(frames*np.hanning(frame).astype(np.float32), axis=1)[:, :bins]
+    return np.square(np.abs(spectrum)).astype(np.float32), hop
+
+
+def estimate_background(audio: np.ndarray, sample_rate: int, start: float = 0.0, threshold_db: float = BACKGROUND_DB) -> BackgroundEstimate:
+    '''
+    Estimates music or noise in mono float audio starting at start seconds. The background is the energy every frequency
+    keeps for SUSTAIN_SECONDS (like the harmonic part of a median-filter HPSS, but with a cheaper minimum filter).
+    Its median level relative to the loud frames decides whether background is present, its spectral flatness
+    whether it is tonal (music) or noise
+    '''
+    end = start+len(audio)/sample_rate
+    power, hop = power_spectrogram(audio, sample_rate)
+    if len(power) == 0:
+        return {"start": start, "end": end, "kind": "clean", "background_db": -120.0, "flatness": 0.0}
+    size = max(1, int(SUSTAIN_SECONDS*sample_rate/hop))
+    # the minimum of noisy bins is far below their mean, so neighbouring bins are averaged first
+    smoothed = uniform_filter1d(power, 9, axis=1)
+    sustained = minimum_filter1d(smoothed, size, axis=0)
+    eps = 1e-10
+    frame_db = 10*np.log10(power.sum(axis=1)+eps)
+    sustained_db = 10*np.log10(sustained.sum(axis=1)+eps)
+    reference = np.percentile(frame_db, 95)
+    background_db = float(np.median(sustained_db)-reference)
+    # flatness of the frames with the most background
+    loudest = sustained[sustained_db >= np.percentile(sustained_db, 50)]+eps
+    flatness = float(np.mean(np.exp(np.log(loudest).mean(axis=1))/loudest.mean(axis=1)))
+    if reference < -60 or background_db < threshold_db:
+        kind = "clean"
+    elif flatness > NOISE_FLATNESS:
+        kind = "noise"
+    else:
+        kind = "music"
+    return {"start": start, "end": end, "kind": kind, "background_db": round(background_db, 1), "flatness": round(flatness, 3)}
+
+
+def estimate_wav_background(reader: WavReader, block_seconds: float, threshold_db: float = BACKGROUND_DB, stop_at_background: bool = True) -> Tuple[bool, List[BackgroundEstimate]]:
+    '''
+    Estimates the background of blocks of a WAV file. Returns whether all (analyzed) blocks are clean.
+    With stop_at_background the analysis stops at the first block with background
+    '''
+    estimates: List[BackgroundEstimate] = []
+    block = max(1, int(block_seconds*reader.frame_rate))
+    for f1 in range(0, reader.frames, block):
+        samples = pcm_to_float(reader.frame_samples(f1, min(f1+block, reader.frames)), reader.sample_width)
+        estimates.append(estimate_background(samples.mean(axis=1), reader.frame_rate, f1/reader.frame_rate, threshold_db))
+        if stop_at_background and estimates[-1]["kind"] != "clean":
+            return False, estimates
+    return all(e["kind"] == "clean" for e in estimates), estimates
@@ -1,5 +1,6 @@
 import argparse
 import os
+from typing import Dict, List
 
 def main():
     parser = argparse.ArgumentParser()
@@ -23,12 +24,16 @@ def main():
                         help="Split voices (after --audio-2-text and --audio-2-voices)")
 
     parser.add_argument("--create-dataset", default=None, type=str,
-                        help="Create dataset for voice-cloning")
+                        help="Create dataset for voice-cloning for a comma-separated list of speakers or 'all'")
 
     parser.add_argument("--slice", default=False, action='store_true',
                         help="Create slices of .wav files")
     parser.add_argument("--viewer",  default=False, action='store_true',
                         help="Open viewer GUI")
+    parser.add_argument("--serve",  default=False, action='store_true',
+                        help="Open viewer in the browser, served from --port")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="Port of --serve")
     parser.add_argument("--transcribe",  default=False, action='store_true',
                         help="Transcribe files to console")
 
@@ -40,44 +45,128 @@ def main():
                         help="Additional space before splits for --slice")
     parser.add_argument("--post",  type=float, default=0.2,
                         help="Additional space after splits for --slice")
+    parser.add_argument("--out-format", type=str, default="wav", choices=["wav", "flac", "opus"],
+                        help="Audio format of --slice")
+    parser.add_argument("--encode-jobs", type=int, default=4,
+                        help="Number of threads encoding slices of --slice")
+    parser.add_argument("--dataset-format", type=str, default="wav", choices=["wav", "shards"],
+                        help="Output of --create-dataset: one .wav file or tar shards with one clip per sample")
+    parser.add_argument("--sample-rate", type=int, default=None,
+                        help="Resample the clips of --create-dataset --dataset-format shards")
+    parser.add_argument("--bit-depth", type=int, default=None, choices=[8, 16, 24, 32],
+                        help="Bit depth of the clips of --create-dataset --dataset-format shards")
+    parser.add_argument("--shard-size", type=float, default=256,
+                        help="Maximum size of a shard of --create-dataset --dataset-format shards in MB")
     parser.add_argument("--threshold",  type=float, default=0.2,
                         help="Threshold for --map-speakers")
+    parser.add_argument("--alignment", type=str, default="linear", choices=["linear", "exponential", "overlap"],
+                        help="Speaker alignment for --text-to-splits and --transcribe")
+    parser.add_argument("--word-timestamps", default=False, action='store_true',
+                        help="Transcribe with word timestamps (--audio-to-text) and assign speakers per word (--text-to-splits, --transcribe)")
+    parser.add_argument("--speech-only", default=False, action='store_true',
+                        help="Transcribe only speech regions with --audio-to-text, from diarization/*.rttm if it exists or else from the audio energy")
+    parser.add_argument("--part-minutes", type=float, default=0,
+                        help="Split files of --audio-to-text into parts of about this length at pauses, transcribed in parallel by --jobs workers")
+    parser.add_argument("--live", type=str, default=None,
+                        help="Transcribe 16-bit PCM (or WAV) from a FIFO, a growing file or stdin ('-') live into output/live/*.jsonl and *.srt")
+    parser.add_argument("--live-rate", type=int, default=16000,
+                        help="Sample rate of raw PCM for --live")
+    parser.add_argument("--live-channels", type=int, default=1,
+                        help="Number of channels of raw PCM for --live")
+    parser.add_argument("--live-step", type=float, default=5,
+                        help="Seconds of audio read before --live transcribes again")
+    parser.add_argument("--live-rttm", type=str, default=None,
+                        help="Growing RTTM file with the speakers of --live")
+    parser.add_argument("--text-batch-size", type=int, default=1,
+                        help="Number of 30s windows (of all files) decoded at once by --audio-to-text. 1 transcribes each file separately")
+    parser.add_argument("--window-minutes", type=float, default=0,
+                        help="Diarize files of --audio-to-voices in overlapping windows of this length and match their speakers by embeddings. 0 diarizes whole files")
+    parser.add_argument("--batch-size", type=int, default=32,
+                        help="Number of speaker turns embedded at once for --map-speakers")
+    parser.add_argument("--turns-per-speaker", type=int, default=1,
+                        help="Number of (longest) turns averaged per speaker for --map-speakers")
+    parser.add_argument("--audio-cache-mb", type=float, default=2048,
+                        help="Memory for decoded audio files of --map-speakers")
     parser.add_argument("--voice-synthesis",  default=False, action='store_true',
                         help="Open voice-synthesis GUI")
     parser.add_argument("--data-path", type=str, default=os.path.join(os.path.dirname(os.path.dirname(__file__)), "data"),
                         help="the path of the data")
     parser.add_argument("--verbose", default=False, action='store_true',
                         help="whether to print out the progress and debug messages")
+    parser.add_argument("--pipeline", type=str, default=None,
+                        help="Run stages per file as soon as their inputs exist, e.g. 'extract,text,voices,splits,slice'")
+    parser.add_argument("--queue-size", type=int, default=4,
+                        help="Maximum number of files waiting between two stages of --pipeline")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of worker processes (each loads its own model)")
+    parser.add_argument("--daemon", nargs="?", const="", default=None,
+                        help="Run a daemon keeping the models loaded, optionally loading the models of comma-separated stages (like --pipeline) at start")
+    parser.add_argument("--use-daemon", default=False, action='store_true',
+                        help="Run --audio-extract-voice, --audio-to-text, --audio-to-voices, --preprocess and --pipeline in the running --daemon")
+    parser.add_argument("--socket", type=str, default=None,
+                        help="Unix socket of --daemon and --use-daemon")
+    parser.add_argument("--chunk-seconds", type=float, default=300,
+                        help="Seconds of audio separated at once by --audio-extract-voice (memory does not grow with the file length)")
+    parser.add_argument("--skip-clean", nargs="?", type=float, const=-40, default=None,
+                        help="Skip --audio-extract-voice for files and chunks without music or noise above this level in dB (default -40) relative to the speech")
     parser.add_argument("--extract-all", default=False, action='store_true',
                         help="Extract all voices from audio (--audio-extract-voice)")
 
     args = parser.parse_args()
     data_path = args.data_path
-    model = None
     verbose = args.verbose
+    jobs = args.jobs
+    if args.daemon is not None:
+        from .daemon import ModelDaemon
+        daemon = ModelDaemon(args.socket, verbose=verbose)
+        daemon.preload(data_path, [s.strip() for s in args.daemon.split(",") if s.strip() != ""], vars(args))
+        daemon.run()
+        return
+    if args.use_daemon:
+        from .daemon import submit
+        daemon_stages: List[str] = []
+        for flag, flag_stages in [(args.audio_extract_voice, ["extract"]), (args.audio_to_text, ["text"]),
+                                  (args.audio_to_voices, ["voices"]), (args.preprocess, ["text", "voices"])]:
+            daemon_stages.extend(s for s in flag_stages if flag and s not in daemon_stages)
+        options = vars(args)
+        if len(daemon_stages) > 0 and not submit({"stages": daemon_stages, "data_path": os.path.abspath(data_path), "verbose": verbose,
+                                           "pipeline": False, "options": options}, args.socket):
+            return
+        if args.pipeline is not None and not submit({"stages": [s.strip() for s in args.pipeline.split(",")],
+                                                     "data_path": os.path.abspath(data_path), "verbose": verbose,
+                                                     "pipeline": True, "options": options}, args.socket):
+            return
+        args.audio_extract_voice = args.audio_to_text = args.audio_to_voices = args.preprocess = False
+        args.pipeline = None
     if args.audio_extract_voice:
-        if model is None:
-            model = "spleeter:2stems"
         from .audioPreprocessing import MultiVoiceExtractor
         MultiVoiceExtractor(data_path, verbose=verbose,
-                            model=model, vocals_only=not args.extract_all).run()
+                            model=args.model or "spleeter:2stems", vocals_only=not args.extract_all, jobs=jobs,
+                            chunk_seconds=args.chunk_seconds, skip_clean_db=args.skip_clean).run()
     if args.audio_to_text:
-        if model is None:
-            model = "medium"
         from .audio2text import MultiTranscriber
-        MultiTranscriber(data_path, verbose=verbose, model=model,
-                         forceLanguage=args.language, english_only=args.language == "english").run()
+        MultiTranscriber(data_path, verbose=verbose, model=args.model or "medium",
+                         forceLanguage=args.language, english_only=args.language == "english", jobs=jobs,
+                         word_timestamps=args.word_timestamps, batch_size=args.text_batch_size,
+                         speech_only=args.speech_only, part_minutes=args.part_minutes).run()
+    if args.live is not None:
+        from .audio2text import MultiTranscriber
+        from .liveTranscribe import LiveTranscriber, PCMSource
+        name = "stdin" if args.live == "-" else os.path.splitext(os.path.basename(args.live))[0]
+        transcriber = MultiTranscriber(data_path, verbose=verbose, model=args.model or "medium",
+                                       forceLanguage=args.language, english_only=args.language == "english")
+        LiveTranscriber(transcriber, PCMSource(args.live, sample_rate=args.live_rate, channels=args.live_channels),
+                        os.path.join(data_path, "output", "live", name+".jsonl"), rttm_path=args.live_rttm,
+                        alignment=args.alignment, step_seconds=args.live_step).run()
     if args.audio_to_voices:
-        if model is None:
-            model = "pyannote/speaker-diarization"
         from .audio2voices import MultiDetector
-        MultiDetector(data_path, verbose=verbose, model=model).run()
+        MultiDetector(data_path, verbose=verbose, model=args.model or "pyannote/speaker-diarization", jobs=jobs, window_minutes=args.window_minutes).run()
 
     if args.preprocess:
         from .audio2text import MultiTranscriber
         from .audio2voices import MultiDetector
-        MultiTranscriber(data_path, verbose=verbose).run()
-        MultiDetector(data_path, verbose=verbose).run()
+        MultiTranscriber(data_path, verbose=verbose, model=args.model or "medium", jobs=jobs).run()
+        MultiDetector(data_path, verbose=verbose, model=args.model or "pyannote/speaker-diarization", jobs=jobs).run()
 
     if args.set_speakers:
         from .setSpeakers import MultiSpeakerSetter
@@ -85,32 +174,54 @@ def main():
 
     if args.map_speakers:
         from .mapSpeakers import MultiSpeakerMapper
-        c= MultiSpeakerMapper(data_path, verbose=verbose)
+        c= MultiSpeakerMapper(data_path, verbose=verbose, batch_size=args.batch_size,
+                              turns_per_speaker=args.turns_per_speaker, audio_cache_mb=args.audio_cache_mb)
         c.run()
         c.process(args.threshold)
 
     if args.text_to_splits:
         from .text2splits import MultiVoiceSplitter
-        MultiVoiceSplitter(data_path, verbose=verbose).run()
+        MultiVoiceSplitter(data_path, verbose=verbose, jobs=jobs,
+                           alignment=args.alignment, word_level=args.word_timestamps).run()
 
     if args.transcribe:
         from .text2splits import MultiVoiceSplitter
-        MultiVoiceSplitter(data_path, verbose=verbose, transcribe=True).run()
+        MultiVoiceSplitter(data_path, verbose=verbose, transcribe=True, jobs=jobs,
+                           alignment=args.alignment, word_level=args.word_timestamps).run()
     if args.viewer:
         from .viewer import MultiViewer
-        MultiViewer(data_path, verbose=verbose).run()
+        MultiViewer(data_path, verbose=verbose, jobs=jobs).run()
+    if args.serve:
+        from .viewerServer import ViewerServer
+        ViewerServer(data_path, verbose=verbose, port=args.port, jobs=jobs).run()
     if args.slice:
         from .sliceAudio import MultiSlicer
         MultiSlicer(data_path, verbose=verbose, pre=args.pre *
-                    1000, post=args.post*1000).run()
+                    1000, post=args.post*1000, jobs=jobs, out_format=args.out_format,
+                    encode_jobs=args.encode_jobs).run()
     if args.create_dataset is not None:
         from .createDataset import DatasetCreator
         c = DatasetCreator(data_path, args.create_dataset, verbose=verbose, pre=args.pre *
-                    1000, post=args.post*1000)
+                    1000, post=args.post*1000, dataset_format=args.dataset_format, sample_rate=args.sample_rate,
+                    bit_depth=args.bit_depth, shard_size_mb=args.shard_size, jobs=jobs)
         c.run()
         c.sample_statistics()
         c.process_samples()
 
+    if args.pipeline is not None:
+        from .pipeline import PipelineRunner, create_stage
+        from .helper import MultiFileHandler
+        stages: Dict[str, MultiFileHandler] = {}
+        for stage in args.pipeline.split(","):
+            stage = stage.strip()
+            try:
+                # the pipeline transcribes each file separately
+                stages[stage] = create_stage(stage, data_path, verbose, {**vars(args), "text_batch_size": 1})
+            except ValueError as e:
+                parser.error(str(e))
+        PipelineRunner(stages, queue_size=args.queue_size,
+                       verbose=verbose).run()
+
     if args.voice_synthesis:
         from .synthesizer import run
         run()
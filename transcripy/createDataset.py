@@ -1,54 +1,246 @@
+import io
+import json
 import os
-from typing import List, Optional, TypedDict
+import tarfile
+from itertools import islice
+from math import gcd
+from multiprocessing.pool import Pool
+from typing import Dict, Iterable, List, Optional, TextIO, Tuple, TypedDict, Union
 
 from transcripy.text2splits import transcribe
-from .helper import MultiFileHandler, Segment, read_split
-from pydub import AudioSegment
+from .helper import MultiFileHandler, Segment, StreamingWavWriter, WavReader, float_to_pcm, pcm_to_float, read_split, slugify, wav_bytes, wav_fmt
 import numpy as np
 
+DATASET_FORMATS = ["wav", "shards"]
 
-class SamplesType(TypedDict):
+
+class SourceSamples(TypedDict):
+    filename: str
+    speakers: Dict[str, List[Segment]]
+
+
+class Utterance(TypedDict):
+    key: str
+    wav: bytes
+    text: str
+    duration: float
+    source: str
+    start: float
+    end: float
+
+
+class ExportOptions(TypedDict):
+    earlier_ms: float
+    extra_ms: float
+    sample_rate: Optional[int]
+    sample_width: Optional[int]
+
+
+# samples encoded per task, so that a worker never holds the clips of a whole source file
+UTTERANCE_BATCH = 64
+
+
+class UtteranceTask(TypedDict):
+    file_idx: int
     filename: str
-    samples: List[Segment]
+    speaker: str
+    # (index of the sample of the speaker in the source file, sample)
+    segments: List[Tuple[int, Segment]]
+    options: ExportOptions
+
+
+def utterance_tasks(sources: List[SourceSamples], options: ExportOptions, batch: int = UTTERANCE_BATCH) -> Iterable[UtteranceTask]:
+    for file_idx, source in enumerate(sources):
+        for speaker, segments in source["speakers"].items():
+            numbered = list(enumerate(segments))
+            for b0 in range(0, len(numbered), batch):
+                yield {"file_idx": file_idx, "filename": source["filename"], "speaker": speaker,
+                       "segments": numbered[b0:b0+batch], "options": options}
+
+
+def encode_utterances(task: UtteranceTask) -> List[Utterance]:
+    '''
+    Encodes a batch of samples of one speaker in one source file into separate WAV files,
+    resampled to the sample rate and width of the options
+    '''
+    options = task["options"]
+    reader = WavReader(task["filename"])
+    is_float = reader.dtype is not None and reader.dtype.kind == "f"
+    sample_rate = options["sample_rate"] or reader.frame_rate
+    sample_width = options["sample_width"] or (2 if is_float else reader.sample_width)
+    fmt = wav_fmt(reader.channels, sample_rate, sample_width)
+    up, down = sample_rate//gcd(sample_rate, reader.frame_rate), reader.frame_rate//gcd(sample_rate, reader.frame_rate)
+    prefix = slugify(task["speaker"]).replace("-", "_")
+    utterances: List[Utterance] = []
+    for idx, segment in task["segments"]:
+        t1 = int(segment["start"]*1000-options["earlier_ms"])
+        t2 = int(segment["end"]*1000+options["extra_ms"]+options["earlier_ms"])
+        f1, f2 = reader.frame_range(t1, t2)
+        if f1 == f2:
+            print("ERROR: Segment is 0s long")
+            continue
+        if up == down and sample_width == reader.sample_width and not is_float:
+            pcm = reader.raw(t1, t2).tobytes()
+            frames = f2-f1
+        else:
+            y = pcm_to_float(reader.samples(t1, t2), reader.sample_width)
+            if up != down:
+                from scipy.signal import resample_poly
+                y = resample_poly(y, up, down, axis=0)
+            pcm = float_to_pcm(y, sample_width)
+            frames = len(y)
+        utterances.append({
+            "key": f"{prefix}_{task['file_idx']:05d}_{idx:05d}",
+            "wav": wav_bytes(fmt, pcm),
+            "text": " ".join(segment["text"].split()),
+            "duration": frames/sample_rate,
+            "source": os.path.basename(task["filename"]),
+            "start": f1/reader.frame_rate,
+            "end": f2/reader.frame_rate})
+    return utterances
+
+
+class ShardWriter:
+    '''
+    Writes samples into tar files (WebDataset shards), starting a new shard before one would exceed shard_size bytes
+    '''
+
+    def __init__(self, output_dir: str, prefix: str, shard_size: int) -> None:
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.shards: List[str] = []
+        self.tar: Optional[tarfile.TarFile] = None
+        self.size = 0
+
+    def write(self, key: str, members: List[Tuple[str, bytes]]) -> str:
+        # every member needs a 512 byte header and is padded to 512 bytes
+        size = sum(512+(len(data)+511)//512*512 for _, data in members)
+        if self.tar is None or (self.size > 0 and self.size+size > self.shard_size):
+            self.close()
+            self.shards.append(f"{self.prefix}-{len(self.shards):06d}.tar")
+            self.tar = tarfile.open(os.path.join(self.output_dir, self.shards[-1]), "w", format=tarfile.USTAR_FORMAT)
+            self.size = 0
+        for extension, data in members:
+            info = tarfile.TarInfo(f"{key}.{extension}")
+            info.size = len(data)
+            info.mode = 0o644
+            self.tar.addfile(info, io.BytesIO(data))
+        self.size += size
+        return self.shards[-1]
+
+    def close(self) -> None:
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+
+
+class ShardExport:
+    '''
+    Shards and metadata of the dataset of one speaker
+    '''
+
+    def __init__(self, output_dir: str, speaker: str, shard_size: int) -> None:
+        self.output_dir = output_dir
+        self.speaker = speaker
+        os.makedirs(output_dir, exist_ok=True)
+        # shards of a previous export would be mixed into the dataset
+        for file in os.listdir(output_dir):
+            if file.startswith(slugify(speaker)+"-") and file.endswith(".tar"):
+                os.remove(os.path.join(output_dir, file))
+        self.shards = ShardWriter(output_dir, slugify(speaker), shard_size)
+        self.csv: TextIO = open(os.path.join(output_dir, "metadata.csv"), "w", encoding="utf-8")
+        self.jsonl: TextIO = open(os.path.join(output_dir, "metadata.jsonl"), "w", encoding="utf-8")
+        self.count = 0
+        self.duration = 0.0
+
+    def write(self, u: Utterance) -> None:
+        info = {"key": u["key"], "text": u["text"], "speaker": self.speaker, "duration": u["duration"],
+                "source": u["source"], "start": u["start"], "end": u["end"]}
+        shard = self.shards.write(u["key"], [
+            ("wav", u["wav"]), ("txt", u["text"].encode("utf-8")), ("json", json.dumps(info).encode("utf-8"))])
+        text = " ".join(u["text"].replace("|", " ").split())
+        self.csv.write(f"{u['key']}|{text}|{text}\n")
+        self.jsonl.write(json.dumps({**info, "shard": shard})+"\n")
+        self.count += 1
+        self.duration += u["duration"]
+
+    def close(self) -> None:
+        self.shards.close()
+        self.csv.close()
+        self.jsonl.close()
 
 
 class DatasetCreator(MultiFileHandler):
-    def __init__(self, data_path: str, speaker: str, verbose: bool = False, pre: float = 200.0, post: float = 0.0) -> None:
+    def __init__(self, data_path: str, speakers: Union[str, List[str]], verbose: bool = False, pre: float = 200.0, post: float = 0.0,
+                 dataset_format: str = "wav", sample_rate: Optional[int] = None, bit_depth: Optional[int] = None,
+                 shard_size_mb: float = 256, jobs: int = 1) -> None:
         super().__init__(data_path, verbose, "voice_splits",
-                         "output/datasets", None, ["json"])
-        self.speaker = speaker
+                         "output/datasets", None, ["json"], manifest=False)
+        if dataset_format not in DATASET_FORMATS:
+            raise ValueError(f"Unknown dataset format {dataset_format}, use one of {DATASET_FORMATS}")
+        if isinstance(speakers, str):
+            speakers = [speaker.strip() for speaker in speakers.split(",")]
+        # None selects all speakers
+        self.speakers: Optional[List[str]] = None if speakers == ["all"] else speakers
+        self.dataset_format = dataset_format
+        self.sample_rate = sample_rate
+        self.sample_width = None if bit_depth is None else bit_depth//8
+        self.shard_size = int(shard_size_mb*1024*1024)
+        # samples are collected by the handler, so only the export runs in parallel
+        self.export_jobs = jobs
         self.extra_ms = pre
         self.crossfade=int((pre+post)/2)
         self.earlier_ms = post
-        self.samples: List[SamplesType] = []
+        self.sources: List[SourceSamples] = []
+        self.found_speakers: Dict[str, None] = {}
 
     def handler(self, input_file: str, output_dir: str, file_idx: int) -> None:
         audio_path = input_file.replace(".json", ".wav").replace(
             "voice_splits", "raw_audio_voices")
         splits = read_split(input_file)
-        for person in splits:
-            if person == self.speaker:
-                self.samples.append(
-                    {"filename": audio_path, "samples": splits[person]})
+        speakers = {person: splits[person] for person in splits
+                    if (self.speakers is None or person in self.speakers) and len(splits[person]) > 0}
+        if len(speakers) > 0:
+            self.sources.append({"filename": audio_path, "speakers": speakers})
+            self.found_speakers.update(dict.fromkeys(speakers))
+
+    def selected_speakers(self) -> List[str]:
+        if self.speakers is None:
+            return list(self.found_speakers)
+        return self.speakers
+
+    def missing_speakers(self) -> List[str]:
+        return [speaker for speaker in self.selected_speakers() if speaker not in self.found_speakers]
 
     def sample_statistics(self):
+        for speaker in self.selected_speakers():
+            self.speaker_statistics(speaker)
+
+    def speaker_statistics(self, speaker: str):
         p = []
         d = []
         w = []
         s = []
-        for sample in self.samples:
-            durations = [s["end"]-s["start"] for s in sample["samples"]]
-            words = [len(s["text"].split(" ")) for s in sample["samples"]]
+        for source in self.sources:
+            if speaker not in source["speakers"]:
+                continue
+            samples = source["speakers"][speaker]
+            durations = [s["end"]-s["start"] for s in samples]
+            words = [len(s["text"].split(" ")) for s in samples]
             w.extend(words)
             d.extend(durations)
-            s.append(len(sample["samples"]))
-            p.append({"num": len(sample["samples"]),
+            s.append(len(samples))
+            p.append({"num": len(samples),
                      "durations": durations, "words": words})
+        if len(p) == 0:
+            print(f"ERROR: No samples of speaker {speaker}")
+            return
         d = np.array(d)
         w = np.array(w)
         s = np.array(s)
         print(f'''
-Speaker {self.speaker}
+Speaker {speaker}
 Total:
  - {len(p)} files  
  - {np.sum(s)} samples
@@ -67,31 +259,73 @@ Per file:
         ''')
 
     def process_samples(self):
-        dataset_audio: Optional[AudioSegment] = None
-        dataset_text:List[Segment] = []
-        audio_output_path = os.path.join(self.output_dir, self.speaker+".wav")
-        text_output_path = os.path.join(self.output_dir, self.speaker+".json")
-        for file in self.samples:
-            audio_file: AudioSegment = AudioSegment.from_wav(
-                file["filename"])
-            for segment in file["samples"]:
-                t1 = int(segment["start"]*1000-self.earlier_ms)
-                t2 = int(segment["end"]*1000+self.extra_ms+self.earlier_ms)
-                if t1==t2:
-                    print("ERROR: Segment is 0s long")
-                    continue
-                a: AudioSegment = audio_file[t1:t2]
-                if dataset_audio is None:
-                    text_start=0
-                else:
+        if self.dataset_format == "shards":
+            self.export_shards()
+            return
+        writers: Dict[str, StreamingWavWriter] = {}
+        dataset_text: Dict[str, List[Segment]] = {}
+        for source in self.sources:
+            audio_file = WavReader(source["filename"])
+            for speaker, segments in source["speakers"].items():
+                for segment in segments:
+                    t1 = int(segment["start"]*1000-self.earlier_ms)
+                    t2 = int(segment["end"]*1000+self.extra_ms+self.earlier_ms)
+                    if t1==t2:
+                        print("ERROR: Segment is 0s long")
+                        continue
+                    if speaker not in writers:
+                        audio_output_path = os.path.join(self.output_dir, speaker+".wav")
+                        writers[speaker] = StreamingWavWriter(audio_output_path, audio_file.channels, audio_file.frame_rate,
+                                                              audio_file.sample_width, self.crossfade)
+                        dataset_text[speaker] = []
+                    dataset_audio = writers[speaker]
+                    # offsets are counted in frames, as the audio is written
                     text_start = dataset_audio.duration_seconds
-                text_end = text_start + \
-                    (segment["end"]-segment["start"]) + \
-                    (self.extra_ms+self.earlier_ms)/1000
-                if dataset_audio is None:
-                    dataset_audio = a
-                else:
-                    dataset_audio=dataset_audio.append(a, self.crossfade)
-                dataset_text.append({"end":text_end,"start":text_start,"text":segment["text"]})
-        dataset_audio.export(audio_output_path, format="wav")
-        transcribe(dataset_text, text_output_path)
+                    dataset_audio.append_range(audio_file, t1, t2)
+                    text_end = dataset_audio.duration_seconds
+                    dataset_text[speaker].append({"end":text_end,"start":text_start,"text":segment["text"]})
+        for speaker in self.missing_speakers():
+            print(f"ERROR: No samples of speaker {speaker}")
+        for speaker, dataset_audio in writers.items():
+            dataset_audio.close()
+            transcribe(dataset_text[speaker], os.path.join(self.output_dir, speaker+".json"))
+
+    def encoded_utterances(self, options: ExportOptions) -> Iterable[Tuple[str, List[Utterance]]]:
+        '''
+        (speaker, encoded batch of samples) in the order of the sources. Workers are given only a few batches
+        at once, so encoded clips do not pile up while the shards are written
+        '''
+        tasks = utterance_tasks(self.sources, options)
+        if self.export_jobs <= 1:
+            for task in tasks:
+                yield task["speaker"], encode_utterances(task)
+            return
+        with Pool(self.export_jobs) as pool:
+            while True:
+                group = list(islice(tasks, 2*self.export_jobs))
+                if len(group) == 0:
+                    return
+                for task, utterances in zip(group, pool.imap(encode_utterances, group)):
+                    yield task["speaker"], utterances
+
+    def export_shards(self):
+        '''
+        Writes one clip per sample into tar shards, with LJSpeech (metadata.csv) and JSONL metadata per speaker
+        '''
+        for speaker in self.missing_speakers():
+            print(f"ERROR: No samples of speaker {speaker}")
+        options: ExportOptions = {"earlier_ms": self.earlier_ms, "extra_ms": self.extra_ms,
+                                  "sample_rate": self.sample_rate, "sample_width": self.sample_width}
+        exports: Dict[str, ShardExport] = {}
+        try:
+            for speaker, utterances in self.encoded_utterances(options):
+                if speaker not in exports:
+                    exports[speaker] = ShardExport(os.path.join(
+                        self.output_dir, slugify(speaker)), speaker, self.shard_size)
+                for u in utterances:
+                    exports[speaker].write(u)
+        finally:
+            for export in exports.values():
+                export.close()
+        for export in exports.values():
+            print(f"Exported {export.count} samples ({export.duration:.2f}s) of speaker {export.speaker} into {len(export.shards.shards)} shards in {export.output_dir}")
@@ -0,0 +1,153 @@
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from threading import Lock
+from typing import Any, Dict, List, Optional, TypedDict
+
+from .helper import ModelCache, MultiFileHandler
+from .pipeline import PipelineRunner, create_stage
+
+
+class Job(TypedDict):
+    stages: List[str]
+    data_path: str
+    verbose: bool
+    # run the stages as --pipeline instead of one after another
+    pipeline: bool
+    options: Dict[str, Any]
+
+
+def default_socket_path() -> str:
+    return os.path.join(tempfile.gettempdir(), f"transcripy-{os.getuid()}.sock")
+
+
+class SocketWriter(io.TextIOBase):
+    '''
+    Sends written text to the client as {"output": text} lines
+    '''
+
+    def __init__(self, connection: socket.socket) -> None:
+        self.file = connection.makefile("w", encoding="utf-8")
+        self.connected = True
+        # stages of a pipeline print from several threads
+        self.lock = Lock()
+
+    def send(self, message: Dict[str, Any]) -> None:
+        with self.lock:
+            if not self.connected:
+                return
+            try:
+                self.file.write(json.dumps(message)+"\n")
+                self.file.flush()
+            except OSError:
+                # the job continues without a client
+                self.connected = False
+
+    def write(self, text: str) -> int:
+        if len(text) > 0:
+            self.send({"output": text})
+        return len(text)
+
+
+class ModelDaemon:
+    '''
+    Keeps the models of all stages it ran loaded and runs jobs of clients (see submit) on a Unix socket, one after another
+    '''
+
+    def __init__(self, socket_path: Optional[str] = None, verbose: bool = False) -> None:
+        self.socket_path = socket_path or default_socket_path()
+        self.verbose = verbose
+        self.models = ModelCache()
+
+    def preload(self, data_path: str, stages: List[str], options: Dict[str, Any]) -> None:
+        for stage in stages:
+            print(f"Loading model of {stage}...")
+            self.models.warm(create_stage(stage, data_path, self.verbose, options))
+
+    def run(self) -> None:
+        if os.path.exists(self.socket_path):
+            if is_running(self.socket_path):
+                print(f"ERROR: A daemon is already running on {self.socket_path}")
+                return
+            os.remove(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        server.listen()
+        print(f"Daemon listening on {self.socket_path} (Ctrl+C to stop)")
+        try:
+            while True:
+                connection, _address = server.accept()
+                with connection:
+                    self.handle(connection)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.remove(self.socket_path)
+
+    def handle(self, connection: socket.socket) -> None:
+        writer = SocketWriter(connection)
+        error: Optional[str] = None
+        try:
+            line = connection.makefile("r", encoding="utf-8").readline()
+            if len(line) == 0:
+                return
+            job: Job = json.loads(line)
+            if self.verbose:
+                print(f"Job {', '.join(job['stages'])} in {job['data_path']}")
+            with redirect_stdout(writer), redirect_stderr(writer):
+                self.run_job(job)
+        except Exception:
+            error = traceback.format_exc()
+            if self.verbose:
+                print(error)
+        writer.send({"done": True, "error": error})
+
+    def run_job(self, job: Job) -> None:
+        # stages run in the daemon process, so that they use the loaded models
+        options = {**job["options"], "jobs": 1}
+        if job["pipeline"]:
+            options["text_batch_size"] = 1
+        stages: Dict[str, MultiFileHandler] = {}
+        for stage in job["stages"]:
+            stages[stage] = self.models.warm(create_stage(stage, job["data_path"], job["verbose"], options))
+        if job["pipeline"]:
+            PipelineRunner(stages, queue_size=options.get("queue_size", 4), verbose=job["verbose"]).run()
+            return
+        for handler in stages.values():
+            handler.run()
+
+
+def is_running(socket_path: Optional[str] = None) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path or default_socket_path())
+        except OSError:
+            return False
+    return True
+
+
+def submit(job: Job, socket_path: Optional[str] = None) -> bool:
+    '''
+    Runs a job in the daemon and prints its output. Returns whether the job succeeded
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path or default_socket_path())
+        client.sendall((json.dumps(job)+"\n").encode("utf-8"))
+        for line in client.makefile("r", encoding="utf-8"):
+            message = json.loads(line)
+            if "output" in message:
+                sys.stdout.write(message["output"])
+                sys.stdout.flush()
+            elif message.get("done"):
+                if message["error"] is not None:
+                    print(f"ERROR in daemon:\n{message['error']}")
+                return message["error"] is None
+    print("ERROR: Connection to daemon lost")
+    return False
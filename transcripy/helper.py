@@ -1,8 +1,16 @@
 
+import hashlib
 import json
+import struct
+import time
+import traceback
+from multiprocessing.pool import Pool
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple, TypedDict, cast
 from tqdm import tqdm
+from pydub import AudioSegment
+from pydub.utils import db_to_float
+import numpy as np
 import os
 import unicodedata
 import re
@@ -36,49 +44,684 @@ def all_files(path: str, filetypes: List[str] = ['mp3', 'aac', 'ogg', 'flac', 'a
     return files
 
 
+class FileFingerprint(TypedDict):
+    size: int
+    mtime_ns: int
+    sha256: str
+
+
+def file_fingerprint(path: str, previous: Optional[FileFingerprint] = None) -> FileFingerprint:
+    '''
+    Content hash of a file. The hash of previous is reused if size and modification time did not change
+    '''
+    if not os.path.isfile(path):
+        return {"size": -1, "mtime_ns": 0, "sha256": ""}
+    stat = os.stat(path)
+    if previous is not None and previous["size"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns:
+        return previous
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+
+
+class ManifestEntry(TypedDict):
+    inputs: Dict[str, FileFingerprint]
+    params: Dict[str, Any]
+    # data returned by the handler, e.g. probed metadata
+    extra: Optional[Dict[str, Any]]
+
+
+class StageManifest:
+    '''
+    Records the input hashes and parameters every output of a stage was built from
+    '''
+
+    def __init__(self, path: str, data_path: str, save_interval: float = 5.0) -> None:
+        self.path = path
+        self.data_path = data_path
+        self.save_interval = save_interval
+        self.entries: Dict[str, ManifestEntry] = {}
+        self.last_save = 0.0
+        self.dirty = False
+        # outputs without entry are only adopted from before the manifest existed, not from failed runs
+        self.existed = os.path.isfile(path)
+        if self.existed:
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+
+    def fingerprint(self, file: str, input_paths: List[str], params: Dict[str, Any]) -> ManifestEntry:
+        previous = self.entries[file]["inputs"] if file in self.entries else {}
+        inputs: Dict[str, FileFingerprint] = {}
+        for path in input_paths:
+            key = os.path.relpath(path, self.data_path).replace("\\", "/")
+            inputs[key] = file_fingerprint(path, previous.get(key))
+        return {"inputs": inputs, "params": params, "extra": None}
+
+    def is_fresh(self, file: str, entry: ManifestEntry) -> bool:
+        if file not in self.entries:
+            return False
+        recorded = self.entries[file]
+        if recorded["params"] != entry["params"]:
+            return False
+        if recorded["inputs"].keys() != entry["inputs"].keys():
+            return False
+        for key, fingerprint in entry["inputs"].items():
+            if recorded["inputs"][key]["sha256"] != fingerprint["sha256"]:
+                return False
+        return True
+
+    def extra(self, file: str, input_path: Optional[str] = None) -> Dict[str, Any]:
+        '''
+        Data recorded with the output of file. With input_path, only if that input did not change since
+        '''
+        if file not in self.entries:
+            return {}
+        if input_path is not None:
+            recorded = self.entries[file]["inputs"].get(os.path.relpath(input_path, self.data_path).replace("\\", "/"))
+            if recorded is None or file_fingerprint(input_path, recorded)["sha256"] != recorded["sha256"]:
+                return {}
+        return self.entries[file].get("extra") or {}
+
+    def record(self, file: str, entry: ManifestEntry, extra: Optional[Dict[str, Any]] = None) -> None:
+        if extra is not None:
+            entry = {**entry, "extra": extra}
+        self.entries[file] = entry
+        self.dirty = True
+        if time.monotonic()-self.last_save > self.save_interval:
+            self.save()
+
+    def save(self, force: bool = False) -> None:
+        if not self.dirty and not force:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path+".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.monotonic()
+        self.dirty = False
+
+
 class MultiFileHandler:
-    def __init__(self, data_path: str, verbose: bool, input_dir: str, output_dir: str, output_filetype: Optional[str], filetypes: List[str] = ['mp3', 'aac', 'ogg', 'flac', 'alac', 'wav', 'aiff'], ignore_existing: bool = False) -> None:
+    # attributes set by load_model, see share_model
+    model_attributes: List[str] = []
+
+    def __init__(self, data_path: str, verbose: bool, input_dir: str, output_dir: str, output_filetype: Optional[str], filetypes: List[str] = ['mp3', 'aac', 'ogg', 'flac', 'alac', 'wav', 'aiff'], ignore_existing: bool = False, jobs: int = 1, manifest: bool = True) -> None:
+        self.data_path = data_path
         self.input_dir = os.path.join(data_path, input_dir)
         self.output_dir = os.path.join(data_path, output_dir)
         self.files = all_files(self.input_dir, filetypes)
+        self.filetypes = filetypes
         self.output_filetype = output_filetype
         self.ignore_existing = ignore_existing
         self.verbose=verbose
+        self.jobs = max(1, jobs)
+        self.model_loaded = False
+        self.manifest: Optional[StageManifest] = None
+        if manifest:
+            self.manifest = StageManifest(os.path.join(
+                self.output_dir, ".manifest.json"), data_path)
 
-    def handler(self, input_file: str, output_file: str, idx: int) -> None:
+    def load_model(self) -> None:
         '''
-        Handler for each file defined by class extending MultiFileHandler
+        Load the model(s) used by handler. Called once per process before the first file is handled
         '''
         pass
 
-    def run(self):
+    def ensure_model(self) -> None:
+        if not self.model_loaded:
+            self.load_model()
+            self.model_loaded = True
+
+    def model_key(self) -> Tuple[Any, ...]:
+        '''
+        Handlers with equal keys load the same model(s)
+        '''
+        return (type(self).__name__, self.params().get("model"))
+
+    def share_model(self, other: "MultiFileHandler") -> None:
+        '''
+        Use the model(s) loaded by another handler with the same model_key instead of loading them again
+        '''
+        for attribute in self.model_attributes:
+            setattr(self, attribute, getattr(other, attribute))
+        self.model_loaded = other.model_loaded
+
+    def handler(self, input_file: str, output_file: str, idx: int) -> Optional[Dict[str, Any]]:
+        '''
+        Handler for each file defined by class extending MultiFileHandler.
+        A returned dict is stored in the manifest entry of the file
+        '''
+        pass
+
+    def dependencies(self, input_file: str) -> List[str]:
+        '''
+        Files besides input_file the output of handler depends on
+        '''
+        return []
+
+    def params(self) -> Dict[str, Any]:
+        '''
+        Model name and parameters the output of handler depends on
+        '''
+        return {}
+
+    def output_path(self, file: str) -> str:
+        if self.output_filetype is not None:
+            return os.path.splitext(
+                os.path.join(self.output_dir, file))[0]+'.'+self.output_filetype
+        return self.output_dir
+
+    def process(self, file: str, idx: int) -> Optional[Dict[str, Any]]:
+        output_file = self.output_path(file)
+        if self.output_filetype is not None:
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        else:
+            os.makedirs(self.output_dir, exist_ok=True)
+        input_file = os.path.join(self.input_dir, file)
+        if self.verbose:
+            print(f"Processing {input_file}\nOutput: {output_file}")
+        return self.handler(input_file, output_file, idx)
+
+    def pool(self) -> Pool:
+        '''
+        Process pool with one handler (and model) per worker
+        '''
+        return Pool(self.jobs, initializer=_init_worker, initargs=(self,))
+
+    def fingerprint(self, file: str) -> Optional[ManifestEntry]:
+        if self.manifest is None:
+            return None
+        input_file = os.path.join(self.input_dir, file)
+        return self.manifest.fingerprint(
+            file, [input_file]+self.dependencies(input_file), self.params())
+
+    def is_stale(self, file: str, entry: Optional[ManifestEntry]) -> bool:
+        output_file = self.output_path(file)
+        if self.ignore_existing:
+            return True
+        if self.manifest is None or entry is None:
+            if os.path.isfile(output_file):
+                print(f"File exists. Skipping... ({output_file})")
+                return False
+            return True
+        if self.output_filetype is not None and not os.path.isfile(output_file):
+            return True
+        if file not in self.manifest.entries and not self.manifest.existed and self.output_filetype is not None:
+            # Output from before the manifest existed. Adopt it instead of rebuilding
+            print(f"File exists. Recording in manifest... ({output_file})")
+            self.manifest.record(file, entry)
+            return False
+        if self.manifest.is_fresh(file, entry):
+            print(f"Up to date. Skipping... ({output_file})")
+            return False
+        if self.verbose:
+            print(f"Outdated. Rebuilding... ({output_file})")
+        return True
+
+    def record(self, file: str, entry: Optional[ManifestEntry], extra: Optional[Dict[str, Any]] = None) -> None:
+        if self.manifest is not None and entry is not None:
+            self.manifest.record(file, entry, extra)
+
+    def pending(self) -> Tuple[List[str], Dict[str, Optional[ManifestEntry]]]:
+        '''
+        Files with missing or outdated output, and the manifest entries of all files
+        '''
         files=[]
+        entries: Dict[str, Optional[ManifestEntry]] = {}
         for idx, file in tqdm(enumerate(self.files)):
-            if self.output_filetype is not None:
-                output_file = os.path.splitext(
-                    os.path.join(self.output_dir, file))[0]+'.'+self.output_filetype
-            else:
-                output_file = self.output_dir
-            if self.ignore_existing or not os.path.isfile(output_file):
+            entries[file] = self.fingerprint(file)
+            if self.is_stale(file, entries[file]):
                 files.append(file)
-            else:
-                print(f"File exists. Skipping... ({output_file})")
+        self.start_manifest()
+        return files, entries
 
-        for idx, file in tqdm(enumerate(files)):
-            if self.output_filetype is not None:
-                output_file = os.path.splitext(
-                    os.path.join(self.output_dir, file))[0]+'.'+self.output_filetype
-                os.makedirs(os.path.dirname(output_file), exist_ok=True)
-            else:
-                os.makedirs(self.output_dir, exist_ok=True)
-                output_file = self.output_dir
-            input_file = os.path.join(self.input_dir, file)
-            if self.ignore_existing or not os.path.isfile(output_file):
-                if self.verbose:
-                    print(f"Processing {input_file}\nOutput: {output_file}")
-                self.handler(input_file, output_file, idx)
-            else:
-                print(f"File exists. Skipping... ({output_file})")
+    def start_manifest(self) -> None:
+        '''
+        Writes the manifest before the first file is handled, so that the next run does not adopt
+        partial outputs of this run if it is interrupted
+        '''
+        if self.manifest is not None and not os.path.isfile(self.manifest.path):
+            self.manifest.save(force=True)
+
+    def run(self):
+        files, entries = self.pending()
+
+        try:
+            if self.jobs == 1 or len(files) <= 1:
+                self.ensure_model()
+                for idx, file in tqdm(enumerate(files)):
+                    try:
+                        result = self.process(file, idx)
+                    except Exception:
+                        # like the worker processes, failed files are reported and not recorded
+                        print(f"Error processing {os.path.join(self.input_dir, file)}\n{traceback.format_exc()}")
+                        continue
+                    self.record(file, entries[file], result)
+                return
+
+            with self.pool() as pool:
+                tasks = [("process", (file, idx)) for idx, file in enumerate(files)]
+                results = pool.imap(_call_worker, tasks)
+                for file, (result, error) in tqdm(zip(files, results), total=len(files)):
+                    if error is not None:
+                        print(f"Error processing {os.path.join(self.input_dir, file)}\n{error}")
+                    else:
+                        self.record(file, entries[file], result)
+        finally:
+            if self.manifest is not None:
+                self.manifest.save()
+
+
+class ModelCache:
+    '''
+    Loaded models of handlers, kept for later handlers with the same model_key
+    '''
+
+    def __init__(self) -> None:
+        self.handlers: Dict[Tuple[Any, ...], MultiFileHandler] = {}
+
+    def warm(self, handler: MultiFileHandler) -> MultiFileHandler:
+        if handler.jobs > 1:
+            # every worker process loads its own model
+            return handler
+        key = handler.model_key()
+        if key in self.handlers:
+            handler.share_model(self.handlers[key])
+        else:
+            handler.ensure_model()
+            self.handlers[key] = handler
+        return handler
+
+
+_worker_handler: Optional[MultiFileHandler] = None
+
+
+def _init_worker(handler: MultiFileHandler) -> None:
+    global _worker_handler
+    _worker_handler = handler
+    handler.ensure_model()
+
+
+def _call_worker(task: Tuple[str, Tuple[Any, ...]]) -> Tuple[Any, Optional[str]]:
+    method, args = task
+    try:
+        return getattr(_worker_handler, method)(*args), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+class WavReader:
+    '''
+    Memory-mapped PCM data of a WAV file. Ranges are returned as views without decoding the whole file
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        fmt: Optional[bytes] = None
+        data_offset = -1
+        data_size = 0
+        with open(path, "rb") as f:
+            riff = f.read(12)
+            if len(riff) < 12 or riff[0:4] != b"RIFF" or riff[8:12] != b"WAVE":
+                raise ValueError(f"{path} is not a WAV file")
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                chunk_id, chunk_size = header[0:4], struct.unpack("<I", header[4:8])[0]
+                if chunk_id == b"fmt ":
+                    fmt = f.read(chunk_size)
+                    f.seek(chunk_size % 2, 1)
+                elif chunk_id == b"data":
+                    data_offset = f.tell()
+                    data_size = chunk_size
+                    break
+                else:
+                    f.seek(chunk_size+chunk_size % 2, 1)
+            file_size = f.seek(0, 2)
+        if fmt is None or data_offset < 0:
+            raise ValueError(f"{path} has no fmt or data chunk")
+        self.fmt = fmt
+        format_tag, self.channels, self.frame_rate, _byte_rate, self.block_align, bits = struct.unpack(
+            "<HHIIHH", fmt[:16])
+        if format_tag == 0xFFFE and len(fmt) >= 26:
+            # WAVE_FORMAT_EXTENSIBLE, the format is the first two bytes of the sub format GUID
+            format_tag = struct.unpack("<H", fmt[24:26])[0]
+        self.sample_width = self.block_align//self.channels
+        if format_tag == 3 and self.sample_width in (4, 8):
+            self.dtype = np.dtype(f"<f{self.sample_width}")
+        elif format_tag == 1 and self.sample_width == 1:
+            self.dtype = np.dtype("u1")
+        elif format_tag == 1 and self.sample_width in (2, 4):
+            self.dtype = np.dtype(f"<i{self.sample_width}")
+        elif format_tag == 1 and self.sample_width == 3:
+            self.dtype = None
+        else:
+            raise ValueError(
+                f"{path}: unsupported WAV format {format_tag} with {bits} bits")
+        # data_size may be wrong for files written by streams
+        data_size = min(data_size, file_size-data_offset)
+        self.frames = data_size//self.block_align
+        self.data = np.memmap(path, dtype=np.uint8, mode="r", offset=data_offset,
+                              shape=(self.frames, self.block_align))
+
+    @property
+    def duration_seconds(self) -> float:
+        return self.frames/self.frame_rate
+
+    def frame_range(self, t1: float, t2: float) -> Tuple[int, int]:
+        '''
+        Frames of [t1, t2) in milliseconds, clipped to the file
+        '''
+        f1 = min(max(int(round(t1*self.frame_rate/1000)), 0), self.frames)
+        f2 = min(max(int(round(t2*self.frame_rate/1000)), f1), self.frames)
+        return f1, f2
+
+    def raw(self, t1: float, t2: float) -> np.ndarray:
+        '''
+        View of the PCM bytes of [t1, t2) in milliseconds, with shape (frames, block_align)
+        '''
+        f1, f2 = self.frame_range(t1, t2)
+        return self.data[f1:f2]
+
+    def samples(self, t1: float = 0, t2: Optional[float] = None) -> np.ndarray:
+        '''
+        Samples of [t1, t2) in milliseconds with shape (frames, channels). A view, except for 24 bit files
+        '''
+        if t2 is None:
+            t2 = self.duration_seconds*1000
+        return self.frame_samples(*self.frame_range(t1, t2))
+
+    def frame_samples(self, f1: int, f2: int) -> np.ndarray:
+        '''
+        Samples of the frames [f1, f2) with shape (frames, channels)
+        '''
+        raw = self.data[f1:f2]
+        if self.dtype is not None:
+            return raw.view(self.dtype).reshape((-1, self.channels))
+        # 24 bit: shift the three bytes into the upper bytes of int32
+        b = raw.reshape((-1, self.channels, 3)).astype(np.int32)
+        return ((b[:, :, 0] << 8) | (b[:, :, 1] << 16) | (b[:, :, 2] << 24)) >> 8
+
+    def segment(self, t1: float, t2: float) -> AudioSegment:
+        '''
+        AudioSegment of [t1, t2) in milliseconds. Only this range is read
+        '''
+        return AudioSegment(data=self.raw(t1, t2).tobytes(), sample_width=self.sample_width,
+                            frame_rate=self.frame_rate, channels=self.channels)
+
+
+def wav_chunk(chunk_id: bytes, data: bytes) -> bytes:
+    return chunk_id+struct.pack("<I", len(data))+data+b"\0"*(len(data) % 2)
+
+
+def wav_fmt(channels: int, frame_rate: int, sample_width: int) -> bytes:
+    '''
+    fmt chunk data of integer PCM
+    '''
+    block_align = channels*sample_width
+    return struct.pack("<HHIIHH", 1, channels, frame_rate, frame_rate*block_align, block_align, 8*sample_width)
+
+
+def wav_bytes(fmt: bytes, pcm: bytes, chunks: List[Tuple[bytes, bytes]] = []) -> bytes:
+    '''
+    Complete WAV file with PCM data and additional chunks (e.g. b"id3 ")
+    '''
+    body = b"".join([b"WAVE", wav_chunk(b"fmt ", fmt), wav_chunk(b"data", pcm)] +
+                    [wav_chunk(chunk_id, data) for chunk_id, data in chunks])
+    return b"RIFF"+struct.pack("<I", len(body))+body
+
+
+def write_wav(path: str, fmt: bytes, pcm: bytes, chunks: List[Tuple[bytes, bytes]] = []) -> None:
+    '''
+    Writes a WAV file with PCM data and additional chunks (e.g. b"id3 ") with a single write
+    '''
+    with open(path, "wb") as f:
+        f.write(wav_bytes(fmt, pcm, chunks))
+
+
+def pcm_to_float(samples: np.ndarray, sample_width: int) -> np.ndarray:
+    '''
+    Converts samples of WavReader.samples into np.float32 in range [-1.0, 1.0]
+    '''
+    if samples.dtype.kind == "f":
+        return samples.astype(np.float32)
+    if samples.dtype.kind == "u":
+        return (samples.astype(np.float32)-128)/128
+    return samples.astype(np.float32) / (1 << (8 * sample_width - 1))
+
+
+def float_to_pcm(y: np.ndarray, sample_width: int) -> bytes:
+    '''
+    Converts np.float32 in range [-1.0, 1.0] of shape [frames, channels] into interleaved PCM data
+    '''
+    if sample_width == 1:
+        return np.clip(np.round(y*128+128), 0, 255).astype("u1").tobytes()
+    scale = 1 << (8*sample_width-1)
+    pcm = np.clip(np.round(y.astype(np.float64)*scale), -scale, scale-1).astype("<i4")
+    if sample_width == 3:
+        return pcm.view("u1").reshape((-1, 4))[:, :3].tobytes()
+    return pcm.astype(f"<i{sample_width}").tobytes()
+
+
+class StreamingWavWriter:
+    '''
+    Writes a WAV file from appended ranges of WavReaders. Like AudioSegment.append, consecutive ranges overlap by
+    crossfade milliseconds. Only the last crossfade milliseconds are kept in memory
+    '''
+
+    def __init__(self, path: str, channels: int, frame_rate: int, sample_width: int, crossfade: float = 0) -> None:
+        self.path = path
+        self.channels = channels
+        self.frame_rate = frame_rate
+        # 24 bit input is written as 32 bit (like pydub)
+        self.sample_width = 4 if sample_width == 3 else sample_width
+        self.dtype = np.dtype("u1") if self.sample_width == 1 else np.dtype(
+            f"<i{self.sample_width}")
+        self.crossfade_frames = int(round(crossfade*frame_rate/1000))
+        self.tail = np.zeros((0, channels), dtype=self.dtype)
+        self.frames_written = 0
+        self.file = open(path, "wb")
+        self.file.write(self.header(0))
+
+    def header(self, data_size: int) -> bytes:
+        fmt = wav_fmt(self.channels, self.frame_rate, self.sample_width)
+        return b"RIFF"+struct.pack("<I", 4+8+len(fmt)+8+data_size)+b"WAVE" + \
+            wav_chunk(b"fmt ", fmt)+b"data"+struct.pack("<I", data_size)
+
+    @property
+    def frames(self) -> int:
+        return self.frames_written+len(self.tail)
+
+    @property
+    def duration_seconds(self) -> float:
+        return self.frames/self.frame_rate
+
+    def samples(self, reader: WavReader, t1: float, t2: float) -> np.ndarray:
+        '''
+        Samples of [t1, t2) in milliseconds, converted to the format of this file if necessary
+        '''
+        if (reader.channels, reader.frame_rate) != (self.channels, self.frame_rate) or reader.sample_width not in (self.sample_width, 3):
+            segment = reader.segment(t1, t2).set_frame_rate(self.frame_rate).set_channels(
+                self.channels).set_sample_width(self.sample_width)
+            return np.frombuffer(segment.raw_data, dtype=self.dtype).reshape((-1, self.channels))
+        samples = reader.samples(t1, t2)
+        if reader.sample_width == 3:
+            return (samples << 8).astype(self.dtype)
+        return samples
+
+    def append_range(self, reader: WavReader, t1: float, t2: float) -> None:
+        self.append(self.samples(reader, t1, t2))
+
+    def append(self, samples: np.ndarray) -> None:
+        n = min(self.crossfade_frames, len(self.tail), len(samples))
+        if n > 0:
+            # like AudioSegment.append: the tail fades out to -120 dB and the samples fade in from -120 dB,
+            # both with linear amplitude ramps (AudioSegment.fade)
+            silence = db_to_float(-120)
+            fade_out = np.linspace(1, silence, n)[:, None]
+            fade_in = np.linspace(silence, 1, n)[:, None]
+            offset = 128 if self.dtype.kind == "u" else 0
+            mixed = (self.tail[-n:].astype(np.float64)-offset)*fade_out + \
+                (samples[:n].astype(np.float64)-offset)*fade_in
+            info = np.iinfo(self.dtype)
+            mixed = np.clip(np.round(mixed)+offset, info.min, info.max).astype(self.dtype)
+            self.write(self.tail[:-n])
+            samples = np.concatenate([mixed, samples[n:]])
+        else:
+            self.write(self.tail)
+        keep = min(self.crossfade_frames, len(samples))
+        self.write(samples[:len(samples)-keep])
+        self.tail = np.array(samples[len(samples)-keep:], dtype=self.dtype)
+
+    def write(self, samples: np.ndarray) -> None:
+        if len(samples) > 0:
+            self.file.write(np.ascontiguousarray(samples, dtype=self.dtype).tobytes())
+            self.frames_written += len(samples)
+
+    def close(self) -> None:
+        self.write(self.tail)
+        self.tail = self.tail[:0]
+        data_size = self.frames_written*self.channels*self.sample_width
+        if data_size % 2:
+            self.file.write(b"\0")
+        self.file.seek(0)
+        self.file.write(self.header(data_size))
+        self.file.close()
+
+
+Region = Tuple[float, float]
+
+
+def energy_vad(audio: np.ndarray, sample_rate: int, frame_ms: float = 30, threshold_db: Optional[float] = None) -> List[Region]:
+    '''
+    Regions (start, end) in seconds of mono float audio whose frame energy is above threshold_db.
+    By default the threshold is 30% between the noise floor and the loud parts of the file
+    '''
+    n = max(1, int(sample_rate*frame_ms/1000))
+    frames = len(audio)//n
+    if frames == 0:
+        return []
+    power = np.square(audio[:frames*n].reshape((frames, n)).astype(np.float32)).mean(axis=1)
+    db = 10*np.log10(power+1e-10)
+    if threshold_db is None:
+        floor, loud = np.percentile(db, [10, 95])
+        threshold_db = max(floor+0.3*(loud-floor), -60.0)
+    active = np.concatenate([[0], (db > threshold_db).astype(np.int8), [0]])
+    changes = np.diff(active)
+    starts = np.flatnonzero(changes == 1)
+    ends = np.flatnonzero(changes == -1)
+    return [(float(a*n/sample_rate), float(b*n/sample_rate)) for a, b in zip(starts, ends)]
+
+
+def merge_regions(regions: List[Region], padding: float = 0.0, duration: Optional[float] = None) -> List[Region]:
+    '''
+    Sorted regions padded by padding seconds on both sides, overlapping regions are merged
+    '''
+    merged: List[Region] = []
+    for start, end in sorted(regions):
+        start = max(0.0, start-padding)
+        end = end+padding if duration is None else min(duration, end+padding)
+        if end <= start:
+            continue
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def pack_regions(regions: List[Region], max_length: float = 30.0) -> List[List[Region]]:
+    '''
+    Groups consecutive regions into chunks of at most max_length seconds (without the gaps between them).
+    Longer regions are split
+    '''
+    chunks: List[List[Region]] = []
+    length = max_length
+    for start, end in regions:
+        while end-start > 0:
+            if length >= max_length:
+                chunks.append([])
+                length = 0.0
+            piece_end = min(end, start+max_length-length)
+            chunks[-1].append((start, piece_end))
+            length += piece_end-start
+            start = piece_end
+    return chunks
+
+
+def split_at_pauses(reader: WavReader, part_seconds: float, pauses: List[Region] = [], search: float = 0.1,
+                    frame_seconds: float = 0.1) -> List[Region]:
+    '''
+    Splits a file into parts of about part_seconds. Every split is moved within search*part_seconds to the middle
+    of the longest pause, or else to the frame with the lowest energy. Only the searched ranges are read
+    '''
+    duration = reader.duration_seconds
+    n = int(round(duration/part_seconds))
+    if n <= 1:
+        return [(0.0, duration)]
+    radius = search*part_seconds
+    frame = max(1, int(frame_seconds*reader.frame_rate))
+    points = [0.0]
+    for k in range(1, n):
+        target = k*duration/n
+        t1, t2 = max(points[-1], target-radius), min(duration, target+radius)
+        inside = [(max(a, t1), min(b, t2)) for a, b in pauses if b > t1 and a < t2]
+        if len(inside) > 0:
+            a, b = max(inside, key=lambda p: p[1]-p[0])
+            points.append((a+b)/2)
+            continue
+        f1, f2 = reader.frame_range(t1*1000, t2*1000)
+        frames = (f2-f1)//frame
+        if frames == 0:
+            points.append(target)
+            continue
+        samples = pcm_to_float(reader.frame_samples(f1, f1+frames*frame), reader.sample_width)
+        energy = np.square(samples).reshape((frames, frame, -1)).mean(axis=(1, 2))
+        points.append((f1+(int(np.argmin(energy))+0.5)*frame)/reader.frame_rate)
+    points.append(duration)
+    return [(a, b) for a, b in zip(points[:-1], points[1:]) if b > a]
+
+
+class UnionFind:
+    '''
+    Disjoint sets of the indices 0..n-1
+    '''
+
+    def __init__(self, n: int) -> None:
+        self.parent = list(range(n))
+        self.rank = [0]*n
+
+    def find(self, idx: int) -> int:
+        root = idx
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[idx] != root:
+            self.parent[idx], idx = root, self.parent[idx]
+        return root
+
+    def union(self, a: int, b: int) -> None:
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if self.rank[a] < self.rank[b]:
+            a, b = b, a
+        self.parent[b] = a
+        if self.rank[a] == self.rank[b]:
+            self.rank[a] += 1
+
+    def groups(self) -> List[List[int]]:
+        '''
+        All sets, ordered by their first index
+        '''
+        groups: Dict[int, List[int]] = {}
+        for idx in range(len(self.parent)):
+            groups.setdefault(self.find(idx), []).append(idx)
+        return list(groups.values())
 
 
 class RTTMLine(TypedDict):
@@ -92,23 +735,26 @@ class OverwriteType(TypedDict):
     rename: List[str]
 
 
-def read_rttm(path: str, load_overwrite: bool = True) -> Tuple[str, List[RTTMLine]]:
+def parse_rttm_line(line: str) -> Optional[Tuple[str, RTTMLine]]:
     # line = (
     #     f"SPEAKER {output.uri} 1 {s.start:.3f} {s.duration:.3f} "
     #     f"<NA> <NA> {l} <NA> <NA>\n"
     # )
+    line_split = line.split(" ")
+    if len(line_split) != 10:
+        return None
+    return line_split[1], {"start": float(line_split[3]), "duration": float(line_split[4]), "speaker": line_split[7]}
+
+
+def read_rttm(path: str, load_overwrite: bool = True) -> Tuple[str, List[RTTMLine]]:
     segments: List[RTTMLine] = []
     uri = ''
     with open(path, 'r') as f:
         for idx, line in enumerate(f):
-            line_split = line.split(" ")
-            if len(line_split) == 10:
-                uri = line_split[1]
-                start = float(line_split[3])
-                duration = float(line_split[4])
-                speaker = line_split[7]
-                segments.append(
-                    {"start": start, "duration": duration, "speaker": speaker})
+            parsed = parse_rttm_line(line)
+            if parsed is not None:
+                uri, segment = parsed
+                segments.append(segment)
             else:
                 print(f"Unknown line {idx+1}")
     if load_overwrite:
@@ -143,6 +789,13 @@ def read_split(path: str) -> Dict[str, List[Segment]]:
     return cast(Dict[str, List[Segment]], data)
 
 
+class WhisperWord(TypedDict):
+    word: str
+    start: float
+    end: float
+    probability: float
+
+
 class WhisperSegment(Segment):
     id: int
     seek: int
@@ -153,6 +806,11 @@ class WhisperSegment(Segment):
     no_speech_prob: float
 
 
+class WhisperWordSegment(WhisperSegment, total=False):
+    # only transcribed with word timestamps
+    words: List[WhisperWord]
+
+
 class TextObject(TypedDict):
     segments: List[WhisperSegment]
     text: str
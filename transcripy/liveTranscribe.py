@@ -0,0 +1,233 @@
+import json
+import os
+import stat
+import struct
+import sys
+import time
+from math import gcd
+from typing import IO, Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .audio2text import MultiTranscriber
+from .helper import RTTMLine, Segment, parse_rttm_line
+from .text2splits import IncrementalAligner
+
+# sample rate of whisper
+SAMPLE_RATE = 16000
+# characters of committed text passed as prompt of the next window
+PROMPT_CHARS = 200
+
+
+def resample(audio: np.ndarray, sample_rate: int) -> np.ndarray:
+    '''
+    Mono audio at SAMPLE_RATE. Resampled as a whole, as the filter of resample_poly starts and ends with silence
+    '''
+    if sample_rate == SAMPLE_RATE:
+        return audio
+    from scipy.signal import resample_poly
+    divisor = gcd(SAMPLE_RATE, sample_rate)
+    return resample_poly(audio, SAMPLE_RATE//divisor, sample_rate//divisor).astype(np.float32)
+
+
+def srt_time(t: float) -> str:
+    ms = int(round(t*1000))
+    return f"{ms//3600000:02d}:{ms//60000 % 60:02d}:{ms//1000 % 60:02d},{ms % 1000:03d}"
+
+
+class PCMSource:
+    '''
+    Reads 16-bit PCM from stdin ("-"), a FIFO or a growing file as mono float32 at its sample rate.
+    A WAV header is skipped and sets the sample rate and channels. A growing file ends when it did not grow for idle_seconds
+    '''
+
+    def __init__(self, path: str, sample_rate: int = SAMPLE_RATE, channels: int = 1, idle_seconds: float = 5.0, poll_seconds: float = 0.2) -> None:
+        self.path = path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.idle_seconds = idle_seconds
+        self.poll_seconds = poll_seconds
+        self.file: IO[bytes]
+        if path == "-":
+            self.file = sys.stdin.buffer
+            self.growing = False
+        else:
+            self.file = open(path, "rb")
+            # pipes block until data arrives, regular files are polled
+            self.growing = stat.S_ISREG(os.fstat(self.file.fileno()).st_mode)
+        self.ended = False
+        self.read_header()
+
+    def read_exact(self, size: int) -> bytes:
+        '''
+        Up to size bytes, fewer only at the end of the stream
+        '''
+        data = b""
+        idle = 0.0
+        while len(data) < size and not self.ended:
+            chunk = self.file.read(size-len(data))
+            if chunk:
+                data += chunk
+                idle = 0.0
+            elif not self.growing or idle >= self.idle_seconds:
+                self.ended = True
+            else:
+                time.sleep(self.poll_seconds)
+                idle += self.poll_seconds
+        return data
+
+    def read_header(self) -> None:
+        self.pending = self.read_exact(12)
+        if len(self.pending) < 12 or self.pending[:4] != b"RIFF" or self.pending[8:12] != b"WAVE":
+            return
+        self.pending = b""
+        while True:
+            header = self.read_exact(8)
+            if len(header) < 8:
+                return
+            chunk_id, size = struct.unpack("<4sI", header)
+            if chunk_id == b"data":
+                return
+            chunk = self.read_exact(size+size % 2)
+            if chunk_id == b"fmt ":
+                _format, self.channels, self.sample_rate, _byte_rate, _align, bits = struct.unpack("<HHIIHH", chunk[:16])
+                if bits != 16:
+                    raise ValueError(f"Only 16-bit PCM is supported, not {bits}-bit")
+
+    def read(self, seconds: float) -> Optional[np.ndarray]:
+        '''
+        The next seconds of audio, fewer at the end of the stream. None after the end
+        '''
+        frame_size = 2*self.channels
+        size = int(seconds*self.sample_rate)*frame_size
+        data = self.pending+self.read_exact(size-len(self.pending))
+        # an incomplete frame is kept for the next read
+        usable = len(data)-len(data) % frame_size
+        self.pending = data[usable:]
+        if usable == 0:
+            return None
+        audio = np.frombuffer(data[:usable], np.int16).reshape((-1, self.channels)).mean(axis=1)/32768.0
+        return audio.astype(np.float32)
+
+    def close(self) -> None:
+        if self.file is not sys.stdin.buffer:
+            self.file.close()
+
+
+class RTTMTail:
+    '''
+    Turns appended to an RTTM file since the last call
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.position = 0
+
+    def read(self) -> List[RTTMLine]:
+        if not os.path.isfile(self.path):
+            return []
+        turns: List[RTTMLine] = []
+        with open(self.path, "r") as f:
+            f.seek(self.position)
+            while True:
+                line = f.readline()
+                # an unfinished line is read again next time
+                if not line.endswith("\n"):
+                    break
+                self.position = f.tell()
+                parsed = parse_rttm_line(line.strip("\n"))
+                if parsed is not None:
+                    turns.append(parsed[1])
+        return turns
+
+
+class LiveTranscriber:
+    '''
+    Transcribes a stream in a rolling window: every step_seconds the window is transcribed again, all segments
+    but the last are committed and the window starts at the end of the committed text. A window of window_seconds
+    is committed completely, so the audio in memory and the lag of the output are bounded.
+    Committed segments are appended to output_path (.jsonl) and its .srt, with speakers of a growing RTTM file
+    '''
+
+    def __init__(self, transcriber: MultiTranscriber, source: PCMSource, output_path: str, rttm_path: Optional[str] = None,
+                 alignment: str = "linear", step_seconds: float = 5.0, window_seconds: float = 30.0) -> None:
+        self.transcriber = transcriber
+        self.source = source
+        self.output_path = output_path
+        self.rttm = RTTMTail(rttm_path) if rttm_path is not None else None
+        self.aligner = IncrementalAligner(alignment)
+        self.step_seconds = step_seconds
+        self.window_seconds = window_seconds
+        self.verbose = transcriber.verbose
+        self.captions = 0
+
+    def transcribe(self, audio: np.ndarray, options: Dict[str, Any], prompt: Optional[str]) -> Tuple[List[Segment], str]:
+        assert self.transcriber.model is not None
+        result = self.transcriber.model.transcribe(audio, initial_prompt=prompt, **options)
+        duration = len(audio)/SAMPLE_RATE
+        segments: List[Segment] = [{"start": min(float(s["start"]), duration), "end": min(float(s["end"]), duration), "text": s["text"]}
+                                   for s in result["segments"] if s["text"].strip() != ""]
+        return segments, result["language"]
+
+    def write(self, jsonl: IO[str], srt: IO[str], segment: Segment, turn: Union[RTTMLine, None]) -> None:
+        speaker = turn["speaker"] if turn is not None else ""
+        jsonl.write(json.dumps({**segment, "speaker": speaker})+"\n")
+        self.captions += 1
+        text = segment["text"].strip()
+        if speaker != "":
+            text = speaker+": "+text
+        srt.write(f"{self.captions}\n{srt_time(segment['start'])} --> {srt_time(segment['end'])}\n{text}\n\n")
+        if self.verbose:
+            print(f"[{srt_time(segment['start'])}] {text}")
+
+    def run(self) -> None:
+        if self.transcriber.model is None:
+            self.transcriber.load_model()
+        options = self.transcriber.transcribe_options()
+        # segments are committed by their timestamps only
+        options.pop("word_timestamps", None)
+        os.makedirs(os.path.dirname(self.output_path), exist_ok=True)
+        srt_path = os.path.splitext(self.output_path)[0]+".srt"
+        # the window is kept at the rate of the source and resampled as a whole, chunks resampled separately click at their borders
+        rate = self.source.sample_rate
+        window = np.zeros(0, dtype=np.float32)
+        # time of the first sample of the window in the stream
+        offset = 0.0
+        prompt: Optional[str] = None
+        print(f"Transcribing {self.source.path} live into {self.output_path}")
+        with open(self.output_path, "w") as jsonl, open(srt_path, "w") as srt:
+            while True:
+                audio = self.source.read(self.step_seconds)
+                final = audio is None
+                if audio is not None:
+                    window = np.concatenate([window, audio])
+                now = offset+len(window)/rate
+                committed: List[Segment] = []
+                if len(window) > 0:
+                    segments, language = self.transcribe(resample(window, rate), options, prompt)
+                    # the language is detected in the first window only
+                    options["language"] = language
+                    if final or len(window) >= self.window_seconds*rate:
+                        committed = segments
+                        cut = len(window)/rate
+                    else:
+                        committed = segments[:-1]
+                        cut = committed[-1]["end"] if len(committed) > 0 else 0.0
+                    for segment in committed:
+                        self.aligner.push({"start": offset+segment["start"], "end": offset+segment["end"], "text": segment["text"]})
+                    window = window[int(round(cut*rate)):]
+                    offset += cut
+                if len(committed) > 0:
+                    prompt = ("".join(s["text"] for s in committed) if prompt is None else prompt +
+                              "".join(s["text"] for s in committed))[-PROMPT_CHARS:]
+                if self.rttm is not None:
+                    self.aligner.add_turns(self.rttm.read())
+                # without a diarization, segments are written immediately
+                for segment, turn in self.aligner.ready(now, final=final or self.rttm is None):
+                    self.write(jsonl, srt, segment, turn)
+                jsonl.flush()
+                srt.flush()
+                if final:
+                    break
+        self.source.close()
+        print(f"Transcribed {offset:.0f}s into {self.captions} segments")
@@ -5,10 +5,12 @@ from scipy.spatial.distance import cdist
 from pyannote.core import Segment
 from pyannote.audio import Audio
 import numpy as np
+import torch
 from tqdm import tqdm
-from typing import Dict, List, Tuple, TypedDict
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple, TypedDict, cast
 
-from .helper import MultiFileHandler, RTTMLine, read_rttm
+from .helper import FileFingerprint, MultiFileHandler, RTTMLine, UnionFind, file_fingerprint, read_rttm
 
 
 class ExistingSpeaker(TypedDict):
@@ -22,18 +24,148 @@ class VerifyType(TypedDict):
     file: str
 
 
+# Number of batches collected before crops are sorted by length and embedded
+BUCKET_BATCHES = 8
+
 # ExistingType = Tuple[Union[str, AudioSegment], str, float, float]
 ExistingType = Tuple[str, str, float, float]
 
 
+def group_nearest(loss_map: np.ndarray, threshold: float) -> List[List[int]]:
+    '''
+    Groups every index with its nearest neighbour, if their distance is below threshold.
+    Groups are ordered by size (largest first), then by their first index
+    '''
+    groups = UnionFind(len(loss_map))
+    if len(loss_map) > 1:
+        nearest = np.argmin(loss_map, axis=1)
+        distance = loss_map[np.arange(len(loss_map)), nearest]
+        for idx in np.flatnonzero(distance < threshold):
+            groups.union(int(idx), int(nearest[idx]))
+    return sorted(groups.groups(), key=len, reverse=True)
+
+
+class AudioFile(TypedDict):
+    waveform: torch.Tensor
+    sample_rate: int
+
+
+class AudioCache:
+    '''
+    Decoded waveforms with a budget of max_bytes. The least recently used waveforms are evicted first.
+    The file of the current turn is kept until release(), even if it alone exceeds the budget
+    '''
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.files: "OrderedDict[str, AudioFile]" = OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def size(file: AudioFile) -> int:
+        return file["waveform"].element_size()*file["waveform"].nelement()
+
+    def get(self, path: str, loader: Callable[[str], AudioFile]) -> AudioFile:
+        if path in self.files:
+            self.hits += 1
+            self.files.move_to_end(path)
+            return self.files[path]
+        self.misses += 1
+        file = loader(path)
+        size = self.size(file)
+        while len(self.files) > 0 and self.resident_bytes+size > self.max_bytes:
+            self.evictions += 1
+            self.release(next(iter(self.files)))
+        self.files[path] = file
+        self.resident_bytes += size
+        return file
+
+    def release(self, path: str) -> None:
+        if path in self.files:
+            self.resident_bytes -= self.size(self.files.pop(path))
+
+    def statistics(self) -> str:
+        return f"Audio cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions, {self.resident_bytes/1024/1024:.1f} MB resident"
+
+
+class EmbeddingStore:
+    '''
+    Turn embeddings on disk (embeddings.npy, memory-mapped) with their keys (embeddings.json).
+    A key is the content hash of the audio file, the speaker label and the turn
+    '''
+
+    def __init__(self, directory: str, data_path: str, model: str) -> None:
+        self.path = os.path.join(directory, "embeddings.npy")
+        self.index_path = os.path.join(directory, "embeddings.json")
+        self.data_path = data_path
+        self.model = model
+        self.keys: Dict[str, int] = {}
+        self.audio: Dict[str, FileFingerprint] = {}
+        self.vectors: Optional[np.ndarray] = None
+        self.new_vectors: List[np.ndarray] = []
+        if os.path.isfile(self.index_path) and os.path.isfile(self.path):
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+            if index["model"] == model:
+                self.keys = {key: idx for idx, key in enumerate(index["keys"])}
+                self.audio = index["audio"]
+                self.vectors = np.load(self.path, mmap_mode="r")
+            else:
+                print(
+                    f'Embeddings were created with {index["model"]}. Recomputing them with {model}')
+
+    def key(self, audio_file: str, speaker: str, line: RTTMLine) -> str:
+        rel_path = os.path.relpath(audio_file, self.data_path).replace("\\", "/")
+        self.audio[rel_path] = file_fingerprint(audio_file, self.audio.get(rel_path))
+        return f'{self.audio[rel_path]["sha256"]}|{speaker}|{line["start"]:.3f}|{line["duration"]:.3f}'
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        if key not in self.keys:
+            return None
+        idx = self.keys[key]
+        if self.vectors is not None and idx < len(self.vectors):
+            return np.asarray(self.vectors[idx])
+        return self.new_vectors[idx-(0 if self.vectors is None else len(self.vectors))]
+
+    def add(self, embeddings: Dict[str, np.ndarray]) -> None:
+        for key, vector in embeddings.items():
+            if key not in self.keys:
+                self.keys[key] = len(self.keys)
+                self.new_vectors.append(vector.astype(np.float32))
+
+    def save(self) -> None:
+        if len(self.new_vectors) == 0:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        new_vectors = np.stack(self.new_vectors)
+        if self.vectors is not None:
+            new_vectors = np.concatenate([self.vectors, new_vectors])
+        tmp_path = self.path+".tmp.npy"
+        np.save(tmp_path, new_vectors)
+        self.vectors = None
+        os.replace(tmp_path, self.path)
+        with open(self.index_path, "w") as f:
+            json.dump({"model": self.model, "keys": sorted(self.keys, key=lambda k: self.keys[k]),
+                       "audio": self.audio}, f)
+        self.vectors = np.load(self.path, mmap_mode="r")
+        self.new_vectors = []
+
+
 class MultiSpeakerMapper(MultiFileHandler):
-    def __init__(self, data_path: str, verbose: bool = False, model: str = "speechbrain/spkrec-ecapa-voxceleb") -> None:
+    def __init__(self, data_path: str, verbose: bool = False, model: str = "speechbrain/spkrec-ecapa-voxceleb", batch_size: int = 32, turns_per_speaker: int = 1, audio_cache_mb: float = 2048) -> None:
         super().__init__(data_path, verbose, "diarization",
-                         "diarization-map", None, ["rttm"])
+                         "diarization-map", None, ["rttm"], manifest=False)
 
         # self.results = []
-        self.cached_audio = {}
+        self.cached_audio = AudioCache(int(audio_cache_mb*1024*1024))
+        self.audio = Audio()
+        self.batch_size = batch_size
+        self.turns_per_speaker = turns_per_speaker
         self.verify = PretrainedSpeakerEmbedding(model)
+        self.store = EmbeddingStore(self.output_dir, data_path, model)
         self.diarizations: Dict[str, List[RTTMLine]] = {}
         # ,
         # device=torch.device("cuda"))
@@ -53,71 +185,24 @@ class MultiSpeakerMapper(MultiFileHandler):
         speakers = list(self.diarizations.keys())
         output_path = os.path.join(self.output_dir, "map.npy")
         output_path2 = os.path.join(self.output_dir, "map.json")
-        if not os.path.isfile(output_path):
-            # self.results = []
-            embeddings = self.get_embeddings()
-            results = self.get_loss_map(embeddings)
-            # for speaker in (tq:=tqdm(speakers)):
-            #             self.results.append(self.compare_speaker(speaker, speakers,tq))
-            results = np.array(results)
-            np.save(output_path, results)
-        else:
-            print(
-                f'Mapping {output_path} already exists. Using it for mapping')
-            results = np.load(output_path)
-        # equalities={}
-        equals = []
-        for speaker1_idx, row in enumerate(results):
-            # speaker1 = speakers[speaker1_idx]
-            for speaker2_idx, v in enumerate(row):
-                # speaker2_idx = np.argmin(row)
-                # speaker2 = speakers[speaker2_idx]
-                if results[speaker1_idx][speaker2_idx] < threshold and np.argmin(results[speaker1_idx]) == speaker2_idx:
-                    equals.append([speaker1_idx, speaker2_idx])
-                    # if speaker1_idx<speaker2_idx:
-                    #     print(f'{speaker1_idx} == {speaker2_idx}')
-                    # else:
-                    #     print(f'{speaker2_idx} == {speaker1_idx}')
-                    # if speaker1 not in equalities and speaker2 not in equalities:
-                    #     equalities[speaker1] = []
-                    # if speaker1 in equalities:
-                    #     if speaker2 not in equalities[speaker1]:
-                    #         equalities[speaker1].append(speaker2)
-                    # else:
-                    #     if speaker1 not in equalities[speaker2]:
-                    #         equalities[speaker2].append(speaker1)
-        used = []
-        groups = []
-        while len(used) < len(equals):
-            current = []
-            for idx2, eq2 in enumerate(equals):
-                if idx2 not in used:
-                    current = eq2
-                    used.append(idx2)
-                    break
-            changes = True
-            while changes:
-                changes = False
-                for idx2, eq2 in enumerate(equals):
-                    if idx2 not in used:
-                        if eq2[0] in current or eq2[1] in current:
-                            # if eq2[0] in current and eq2[1] in current:
-                            #     continue
-                            if eq2[0] in current:
-                                if eq2[1] not in current:
-                                    current.append(eq2[1])
-                            else:
-                                if eq2[0] not in current:
-                                    current.append(eq2[0])
-                            changes = True
-                            used.append(idx2)
-            groups.append(current)
-        all = []
-        for g in groups:
-            all.extend(g)
-        for idx in range(len(results)):
-            if idx not in all:
-                groups.append([idx])
+        keys_path = os.path.join(self.output_dir, "map-keys.json")
+        embeddings, speaker_keys = self.get_embeddings()
+        keys = [speaker_keys[speaker] for speaker in speakers]
+        previous: Optional[Tuple[List[str], np.ndarray]] = None
+        if os.path.isfile(output_path) and os.path.isfile(keys_path):
+            with open(keys_path, "r") as f:
+                previous_keys = json.load(f)
+            # distances of another embedding model are not comparable
+            if isinstance(previous_keys, dict) and previous_keys["model"] == self.store.model:
+                previous = (previous_keys["keys"], np.load(output_path, mmap_mode="r"))
+            else:
+                print(f'Speaker map was created with another model. Recomputing it with {self.store.model}')
+        results = self.get_loss_map(embeddings, keys, previous)
+        np.save(output_path, results)
+        with open(keys_path, "w") as f:
+            json.dump({"model": self.store.model, "keys": keys}, f)
+        # Every speaker is grouped with its nearest speaker, if it is closer than threshold
+        groups = group_nearest(results, threshold)
 
         for idx, eq in enumerate(groups):
             print(f'Group {idx}: {len(eq)}')
@@ -170,45 +255,109 @@ class MultiSpeakerMapper(MultiFileHandler):
     #             speaker2_line = line
     #     return self.verify_speaker(speaker1_line, speaker1_file, speaker2_line, speaker2_file)
 
-    def get_embeddings(self):
-        embeddings = {}
-        for speaker in tqdm(self.diarizations):
-            speaker_file = speaker.split("|")[0]
-            speaker_line = self.diarizations[speaker][0]
-            for line in self.diarizations[speaker]:
-                if line["duration"] > speaker_line["duration"]:
-                    speaker_line = line
-            embeddings[speaker] = self.get_speaker_embedding(
-                speaker_line, speaker_file)
+    def get_embeddings(self) -> Tuple[Dict[str, np.ndarray], Dict[str, str]]:
+        '''
+        Embedding and key (its turns in the embedding store) of every speaker. Only turns missing in the store are embedded
+        '''
+        # The longest turns of every speaker, ordered by file so that every file is loaded once
+        speaker_turns: Dict[str, List[str]] = {}
+        requests: List[Tuple[str, str, RTTMLine]] = []
+        for speaker in sorted(self.diarizations, key=lambda speaker: speaker.split("|")[0]):
+            audio_file, label = speaker.split("|")
+            lines = sorted(self.diarizations[speaker], key=lambda line: line["duration"],
+                           reverse=True)[:self.turns_per_speaker]
+            speaker_turns[speaker] = []
+            for line in lines:
+                key = self.store.key(audio_file, label, line)
+                speaker_turns[speaker].append(key)
+                if self.store.get(key) is None:
+                    requests.append((key, audio_file, line))
+        print(
+            f'Embedding {len(requests)} turns ({sum(len(t) for t in speaker_turns.values())-len(requests)} cached)')
+        pending: List[Tuple[str, torch.Tensor]] = []
+        for idx, (key, audio_file, line) in enumerate(tqdm(requests)):
+            pending.append((key, self.get_speaker_crop(line, audio_file)))
+            if idx+1 == len(requests) or requests[idx+1][1] != audio_file:
+                # requests are ordered by file, so this file is not needed anymore
+                self.cached_audio.release(audio_file)
+            if len(pending) >= self.batch_size*BUCKET_BATCHES:
+                self.store.add(self.embed_crops(pending))
+                pending = []
+        self.store.add(self.embed_crops(pending))
+        self.store.save()
+        if self.verbose:
+            print(self.cached_audio.statistics())
+        embeddings: Dict[str, np.ndarray] = {}
+        speaker_keys: Dict[str, str] = {}
+        for speaker in self.diarizations:
+            turns = [cast(np.ndarray, self.store.get(key))
+                     for key in speaker_turns[speaker]]
+            speaker_keys[speaker] = ";".join(speaker_turns[speaker])
+            if len(turns) == 1:
+                embeddings[speaker] = turns[0][None]
+            else:
+                normalized = [t/np.linalg.norm(t) for t in turns]
+                embeddings[speaker] = np.nanmean(
+                    np.stack(normalized), axis=0, keepdims=True)
+        return embeddings, speaker_keys
+
+    def embed_crops(self, crops: List[Tuple[str, torch.Tensor]]) -> Dict[str, np.ndarray]:
+        '''
+        Embeds crops in batches of similar length. Shorter crops are zero-padded and masked
+        '''
+        embeddings: Dict[str, np.ndarray] = {}
+        crops = sorted(crops, key=lambda c: c[1].shape[-1])
+        for b0 in range(0, len(crops), self.batch_size):
+            batch = crops[b0:b0+self.batch_size]
+            num_samples = max(c[1].shape[-1] for _s, c in batch)
+            waveforms = torch.zeros(
+                (len(batch), batch[0][1].shape[0], num_samples))
+            masks = torch.zeros((len(batch), num_samples))
+            for idx, (_key, crop) in enumerate(batch):
+                waveforms[idx, :, :crop.shape[-1]] = crop
+                masks[idx, :crop.shape[-1]] = 1.0
+            result = self.verify(waveforms, masks=masks)
+            for idx, (key, _crop) in enumerate(batch):
+                embeddings[key] = result[idx]
         return embeddings
 
-    def get_loss_map(self, embeddings: Dict[str, float]):
-        loss_map = []
-        for idx1, speaker1 in enumerate(embeddings):
-            line = []
-            for idx2, speaker2 in enumerate(embeddings):
-                # if idx1 < idx2:
-                #     line.append(np.inf)
-                if speaker1 == speaker2:
-                    line.append(np.inf)
-                else:
-                    line.append(
-                        cdist(embeddings[speaker1], embeddings[speaker2], metric="cosine")[0][0])
-            loss_map.append(line)
+    def get_loss_map(self, embeddings: Dict[str, np.ndarray], keys: Optional[List[str]] = None, previous: Optional[Tuple[List[str], np.ndarray]] = None, block_size: int = 1024) -> np.ndarray:
+        '''
+        Cosine distances between all speakers (inf on the diagonal), computed in blocks of rows.
+        Distances between speakers (keys) of a previous map are copied, only rows of new speakers are computed
+        '''
+        x = np.concatenate([embeddings[speaker] for speaker in embeddings])
+        loss_map = np.empty((len(x), len(x)), dtype=np.float32)
+        missing = np.arange(len(x))
+        if keys is not None and previous is not None:
+            previous_idx = {key: idx for idx, key in enumerate(previous[0])}
+            present = [idx for idx, key in enumerate(keys) if key in previous_idx]
+            if len(present) > 0:
+                old = [previous_idx[keys[idx]] for idx in present]
+                loss_map[np.ix_(present, present)] = previous[1][np.ix_(old, old)]
+                missing = np.setdiff1d(missing, present)
+                print(f'Reusing distances of {len(present)} speakers')
+        for b0 in range(0, len(missing), block_size):
+            rows = missing[b0:b0+block_size]
+            loss_map[rows] = cdist(x[rows], x, metric="cosine")
+            loss_map[:, rows] = loss_map[rows].T
+        np.fill_diagonal(loss_map, np.inf)
         return loss_map
 
+    def load_audio(self, audio_file: str) -> AudioFile:
+        waveform, sample_rate = self.audio(audio_file)
+        return {"waveform": waveform, "sample_rate": sample_rate}
+
+    def get_speaker_crop(self, line: RTTMLine, audio_file: str) -> torch.Tensor:
+        file = self.cached_audio.get(audio_file, self.load_audio)
+        speaker1 = Segment(line["start"], line["start"]+line["duration"])
+        waveform, sample_rate = self.audio.crop(file, speaker1)
+        # copy, so that the crop does not keep the whole waveform in memory
+        return waveform.clone()
+
     def get_speaker_embedding(self, line: RTTMLine, audio_file: str):
-        if audio_file in self.cached_audio:
-            file = self.cached_audio[audio_file]
-        else:
-            new_audio = Audio()(audio_file)
-            new_audio = {"waveform": new_audio[0], "sample_rate": new_audio[1]}
-            self.cached_audio[audio_file] = new_audio
-            file = new_audio
-        audio = Audio()
         # extract embedding for a speaker speaking between t=3s and t=6s
-        speaker1 = Segment(line["start"], line["start"]+line["duration"])
-        waveform, sample_rate = audio.crop(file, speaker1)
+        waveform = self.get_speaker_crop(line, audio_file)
         return self.verify(waveform[None])
 
     # def verify_speaker(self, new: RTTMLine, new_file: str, old: RTTMLine, old_file:str) -> float:
@@ -0,0 +1,208 @@
+import os
+import threading
+import time
+from queue import Queue
+from typing import Any, Dict, List, Optional
+
+from .helper import MultiFileHandler
+
+# Stages a stage depends on, in the order they are run by cli.main
+STAGE_DEPENDENCIES: Dict[str, List[str]] = {
+    "extract": [],
+    "text": ["extract"],
+    "voices": ["extract"],
+    "splits": ["text", "voices"],
+    "slice": ["splits"],
+}
+
+
+def stage_dependencies(stage: str, handler: MultiFileHandler) -> List[str]:
+    '''
+    Stages the handler of stage depends on. With speech_only the text stage reads the diarization of the voices stage
+    '''
+    if stage == "text" and getattr(handler, "speech_only", False):
+        return STAGE_DEPENDENCIES[stage]+["voices"]
+    return STAGE_DEPENDENCIES[stage]
+
+
+def create_stage(stage: str, data_path: str, verbose: bool = False, options: Dict[str, Any] = {}) -> MultiFileHandler:
+    '''
+    Handler of a stage, configured by options named like the arguments of cli.main
+    '''
+    if stage == "extract":
+        from .audioPreprocessing import CHUNK_SECONDS, MultiVoiceExtractor
+        return MultiVoiceExtractor(data_path, verbose=verbose, model=options.get("model") or "spleeter:2stems",
+                                   vocals_only=not options.get("extract_all", False),
+                                   chunk_seconds=options.get("chunk_seconds", CHUNK_SECONDS),
+                                   skip_clean_db=options.get("skip_clean"))
+    if stage == "text":
+        from .audio2text import MultiTranscriber
+        return MultiTranscriber(data_path, verbose=verbose, model=options.get("model") or "medium",
+                                forceLanguage=options.get("language"), english_only=options.get("language") == "english",
+                                word_timestamps=options.get("word_timestamps", False),
+                                batch_size=options.get("text_batch_size", 1), speech_only=options.get("speech_only", False),
+                                part_minutes=options.get("part_minutes", 0))
+    if stage == "voices":
+        from .audio2voices import MultiDetector
+        return MultiDetector(data_path, verbose=verbose, model=options.get("model") or "pyannote/speaker-diarization",
+                             window_minutes=options.get("window_minutes", 0))
+    if stage == "splits":
+        from .text2splits import MultiVoiceSplitter
+        return MultiVoiceSplitter(data_path, verbose=verbose, alignment=options.get("alignment", "linear"),
+                                  word_level=options.get("word_timestamps", False))
+    if stage == "slice":
+        from .sliceAudio import MultiSlicer
+        return MultiSlicer(data_path, verbose=verbose, pre=options.get("pre", 0)*1000, post=options.get("post", 0.2)*1000,
+                           out_format=options.get("out_format", "wav"), encode_jobs=options.get("encode_jobs", 4))
+    raise ValueError(
+        f"Unknown stage '{stage}'. Available stages: {', '.join(STAGE_DEPENDENCIES.keys())}")
+
+
+class PipelineRunner:
+    '''
+    Runs several stages as a per-file DAG. Every stage runs in its own thread and starts on a file
+    as soon as all upstream stages finished it. Stages are connected by bounded queues.
+    '''
+
+    def __init__(self, stages: Dict[str, MultiFileHandler], queue_size: int = 4, verbose: bool = False) -> None:
+        for stage in stages:
+            if stage not in STAGE_DEPENDENCIES:
+                raise ValueError(
+                    f"Unknown stage '{stage}'. Available stages: {', '.join(STAGE_DEPENDENCIES.keys())}")
+        self.stages = stages
+        self.verbose = verbose
+        self.upstream: Dict[str, List[str]] = {stage: [
+            d for d in stage_dependencies(stage, stages[stage]) if d in stages] for stage in stages}
+        self.downstream: Dict[str, List[str]] = {stage: [
+            d for d in stages if stage in self.upstream[d]] for stage in stages}
+        self.queues: Dict[str, "Queue[Optional[str]]"] = {
+            stage: Queue(maxsize=queue_size) for stage in stages}
+        self.lock = threading.Lock()
+        self.pending: Dict[str, Dict[str, int]] = {stage: {} for stage in stages}
+        self.open_upstream: Dict[str, int] = {
+            stage: len(self.upstream[stage]) for stage in stages}
+        self.sources: Dict[str, Dict[str, str]] = {}
+        self.completed: Dict[str, int] = {stage: 0 for stage in stages}
+        self.failed: Dict[str, int] = {stage: 0 for stage in stages}
+        self.start_time = 0.0
+
+    def roots(self) -> List[str]:
+        return [stage for stage in self.stages if len(self.upstream[stage]) == 0]
+
+    def file_for(self, stage: str, base: str) -> str:
+        '''
+        Input file of stage (relative to its input_dir) for the file base name
+        '''
+        if base in self.sources.get(stage, {}):
+            return self.sources[stage][base]
+        return base+'.'+self.stages[stage].filetypes[0]
+
+    def downstream_file(self, stage: str, downstream: str, file: str) -> str:
+        '''
+        Input file of downstream (relative to its input_dir) for the file stage handled: the output of stage,
+        if downstream reads it, or the same file, if both read the same directory
+        '''
+        handler = self.stages[stage]
+        target = self.stages[downstream]
+        if handler.output_filetype is not None:
+            output = os.path.relpath(handler.output_path(file), target.input_dir)
+            if not output.startswith(os.pardir):
+                return output
+        if os.path.abspath(handler.input_dir) == os.path.abspath(target.input_dir):
+            return file
+        return os.path.splitext(file)[0]+'.'+target.filetypes[0]
+
+    def run(self) -> None:
+        self.start_time = time.monotonic()
+        bases: List[str] = []
+        for stage in self.roots():
+            self.sources[stage] = {}
+            for file in self.stages[stage].files:
+                base = os.path.splitext(file)[0]
+                self.sources[stage][base] = file
+                if base not in bases:
+                    bases.append(base)
+        print(f"Pipeline: {' -> '.join(self.stages.keys())} ({len(bases)} files)")
+        threads = [threading.Thread(target=self.worker, args=(stage,), name=stage, daemon=True)
+                   for stage in self.stages]
+        for thread in threads:
+            thread.start()
+        for base in bases:
+            for stage in self.roots():
+                if base in self.sources[stage]:
+                    self.queues[stage].put(base)
+        for stage in self.roots():
+            self.queues[stage].put(None)
+        for thread in threads:
+            thread.join()
+        for stage in self.stages:
+            print(
+                f"{stage}: {self.completed[stage]} done, {self.failed[stage]} failed")
+
+    def worker(self, stage: str) -> None:
+        handler = self.stages[stage]
+        loaded = True
+        try:
+            handler.ensure_model()
+        except Exception as e:
+            # Keep consuming the queue, so that upstream stages do not block
+            print(f"[{stage}] Could not load model: {e!r}")
+            loaded = False
+        handler.start_manifest()
+        try:
+            idx = 0
+            while True:
+                base = self.queues[stage].get()
+                if base is None:
+                    break
+                if not loaded:
+                    with self.lock:
+                        self.failed[stage] += 1
+                elif self.handle(stage, handler, base, idx):
+                    self.finished_file(stage, base)
+                idx += 1
+        finally:
+            if handler.manifest is not None:
+                handler.manifest.save()
+            self.finished_stage(stage)
+
+    def handle(self, stage: str, handler: MultiFileHandler, base: str, idx: int) -> bool:
+        file = self.file_for(stage, base)
+        try:
+            entry = handler.fingerprint(file)
+            if handler.is_stale(file, entry):
+                result = handler.process(file, idx)
+                handler.record(file, entry, result)
+        except Exception as e:
+            print(f"[{stage}] Error processing {file}: {e!r}")
+            with self.lock:
+                self.failed[stage] += 1
+            return False
+        with self.lock:
+            self.completed[stage] += 1
+            for downstream in self.downstream[stage]:
+                self.sources.setdefault(downstream, {})[base] = self.downstream_file(stage, downstream, file)
+        if self.verbose or len(self.downstream[stage]) == 0:
+            print(
+                f"[{stage}] {file} ({time.monotonic()-self.start_time:.1f}s)")
+        return True
+
+    def finished_file(self, stage: str, base: str) -> None:
+        for downstream in self.downstream[stage]:
+            with self.lock:
+                remaining = self.pending[downstream].get(
+                    base, len(self.upstream[downstream]))-1
+                if remaining == 0:
+                    self.pending[downstream].pop(base, None)
+                else:
+                    self.pending[downstream][base] = remaining
+            if remaining == 0:
+                self.queues[downstream].put(base)
+
+    def finished_stage(self, stage: str) -> None:
+        for downstream in self.downstream[stage]:
+            with self.lock:
+                self.open_upstream[downstream] -= 1
+                remaining = self.open_upstream[downstream]
+            if remaining == 0:
+                self.queues[downstream].put(None)
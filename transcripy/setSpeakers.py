@@ -12,7 +12,7 @@ from pydub.utils import get_player_name
 import subprocess
 # import torch
 
-from .helper import MultiFileHandler, OverwriteType, RTTMLine, all_files, read_rttm
+from .helper import MultiFileHandler, OverwriteType, RTTMLine, WavReader, all_files, read_rttm
 
 
 def play_with_native(seg: AudioSegment) -> None:
@@ -45,7 +45,7 @@ ExistingType = Tuple[str, str, float, float]
 class MultiSpeakerSetter(MultiFileHandler):
     def __init__(self, data_path: str, verbose: bool = False, model: str = "pyannote/speaker-diarization") -> None:
         super().__init__(data_path, verbose, "diarization",
-                         "diarization", "json", ["rttm"], ignore_existing=True)
+                         "diarization", "json", ["rttm"], ignore_existing=True, manifest=False)
         self.earlier_ms = 200
         self.extra_ms = 500
         self.existing_speakers: Dict[str, Dict[str, List[RTTMLine]]] = {}
@@ -99,7 +99,7 @@ class MultiSpeakerSetter(MultiFileHandler):
         if os.path.isfile(overwrite_path):
             with open(overwrite_path, "r") as f:
                 overwrite = json.load(f)
-        audio_file: AudioSegment = AudioSegment.from_wav(audio_path)
+        audio_file = WavReader(audio_path)
         unknown_speakers = []
         for d in diarization:
             if d["speaker"] not in unknown_speakers:
@@ -119,7 +119,7 @@ class MultiSpeakerSetter(MultiFileHandler):
                 t1 = int(d["start"]*1000-self.earlier_ms)
                 t2 = int((d["start"]+d["duration"])*1000 +
                          self.extra_ms+self.earlier_ms)
-                a: AudioSegment = audio_file[t1:t2]
+                a: AudioSegment = audio_file.segment(t1, t2)
                 # if self.verify is not None:
                 #     new_speaker = self.find_speaker(
                 #         audio_path, diarization, d["speaker"])
@@ -4,35 +4,40 @@ from typing import Optional
 from consolemenu import ConsoleMenu
 from consolemenu.items import FunctionItem
 
+from .helper import ModelCache
+
+# models stay loaded between menu selections
+models = ModelCache()
+
 
 def audio_extract_voice(data_path: str, verbose: bool = False, model: Optional[str] = None, vocals_only: bool = True) -> None:
     if model is None:
         model = "spleeter:2stems"
     from .audioPreprocessing import MultiVoiceExtractor
-    MultiVoiceExtractor(data_path, verbose=verbose,
-                        model=model, vocals_only=vocals_only).run()
+    models.warm(MultiVoiceExtractor(data_path, verbose=verbose,
+                                    model=model, vocals_only=vocals_only)).run()
 
 
 def audio_to_text(data_path: str, verbose: bool = False, model: Optional[str] = None, language: Optional[str] = None) -> None:
     if model is None:
         model = "medium"
     from .audio2text import MultiTranscriber
-    MultiTranscriber(data_path, verbose=verbose, model=model,
-                     forceLanguage=language, english_only=language == "english").run()
+    models.warm(MultiTranscriber(data_path, verbose=verbose, model=model,
+                                 forceLanguage=language, english_only=language == "english")).run()
 
 
 def audio_to_voices(data_path: str, verbose: bool = False, model: Optional[str] = None) -> None:
     if model is None:
         model = "pyannote/speaker-diarization"
     from .audio2voices import MultiDetector
-    MultiDetector(data_path, verbose=verbose, model=model).run()
+    models.warm(MultiDetector(data_path, verbose=verbose, model=model)).run()
 
 
 def preprocess(data_path: str, verbose: bool = False) -> None:
     from .audio2text import MultiTranscriber
     from .audio2voices import MultiDetector
-    MultiTranscriber(data_path, verbose=verbose).run()
-    MultiDetector(data_path, verbose=verbose).run()
+    models.warm(MultiTranscriber(data_path, verbose=verbose)).run()
+    models.warm(MultiDetector(data_path, verbose=verbose)).run()
 
 
 def set_speakers(data_path: str, verbose: bool = False) -> None:
@@ -68,8 +73,8 @@ def slice(data_path: str, verbose: bool = False, pre: float = 0, post: float = 0
 
 def create_dataset(data_path: str, verbose: bool = False, pre: float = 0, post: float = 0) -> None:
     from .createDataset import DatasetCreator
-    speaker = input('Select a speaker name: ')
-    c = DatasetCreator(data_path, speaker, verbose=verbose, pre=pre *
+    speakers = input('Select speaker names (comma-separated or "all"): ')
+    c = DatasetCreator(data_path, speakers, verbose=verbose, pre=pre *
                        1000, post=post*1000)
     c.run()
     c.sample_statistics()
@@ -1,10 +1,36 @@
 import os
-from typing import Dict, TypedDict
-from .helper import MultiFileHandler, Segment, read_split, slugify
+import io
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, TypedDict, cast
 from pydub import AudioSegment
-from pydub.utils import mediainfo
-from mutagen import wave
-from mutagen.id3._frames import TextFrame, Frame
+from .helper import MultiFileHandler, Segment, WavReader, read_split, slugify, write_wav
+from mutagen.id3 import ID3, TALB, TCON, TIT2, TOFN, TPE1, TPE2, TRCK
+
+
+class SourceInfo(TypedDict):
+    filename: str
+    sample_rate: int
+    channels: int
+    sample_width: int
+    duration: float
+
+
+class SliceTags(TypedDict):
+    album: str
+    artist: str
+    track: str
+    filename: str
+    genre: str
+    title: str
+
+
+# output formats and their ffmpeg codec
+OUT_FORMATS: Dict[str, Optional[str]] = {
+    "wav": None,
+    "flac": "flac",
+    "opus": "libopus",
+}
 
 
 class MediaInfoMin(TypedDict):
@@ -62,54 +88,102 @@ class MediaInfo(MediaInfoMin):
 #         "genre": str(start/1000),
 #         "title":segment["text"]
 #     }
-def set_metadata(wav_filename: str, index: int, speaker: str, orig_filename: str, start: int, end: int, segment: Segment, metadata: MediaInfo) -> None:
+def probe(audio_file: WavReader) -> SourceInfo:
+    return {"filename": audio_file.path, "sample_rate": audio_file.frame_rate, "channels": audio_file.channels,
+            "sample_width": audio_file.sample_width, "duration": audio_file.duration_seconds}
+
+
+def slice_tags(index: int, speaker: str, orig_filename: str, start: int, end: int, segment: Segment, metadata: SourceInfo) -> SliceTags:
     album_name = metadata["filename"][metadata["filename"].find(
         "raw_audio_voices")+17:].replace("\\", " ")
-    artist = speaker
-    # turn it into an mp3 object using the mutagen library
-    mp3file = wave.WAVE(wav_filename)
-    # set the album name
-    mp3file['album'] = TextFrame(encoding=3, text=[album_name])
-    mp3file.tags["ALBUM"] = Frame(encoding=3, text=album_name)
-    # set the albumartist name
-    mp3file['albumartist'] = TextFrame(encoding=3, text=[artist])
-    mp3file.tags["ARTIST"] = Frame(encoding=3, text=artist)
-    # set the track number with the proper format
-    mp3file['tracknumber'] = TextFrame(encoding=3, text=str(index))
-    mp3file['filename'] = TextFrame(
-        encoding=3, text=os.path.split(orig_filename)[1])
-    mp3file['genre'] = TextFrame(encoding=3, text=str(start/1000))
-    mp3file['title'] = TextFrame(encoding=3, text=segment["text"])
-    # save the changes that we've made
-    mp3file.tags.save(wav_filename)
-    mp3file.save()
+    return {"album": album_name, "artist": speaker, "track": str(index),
+            "filename": os.path.split(orig_filename)[1], "genre": str(start/1000), "title": segment["text"]}
+
+
+def ffmpeg_tags(tags: SliceTags) -> Dict[str, str]:
+    return {"album": tags["album"], "artist": tags["artist"], "album_artist": tags["artist"], "track": tags["track"],
+            "original_filename": tags["filename"], "genre": tags["genre"], "title": tags["title"]}
+
+
+def id3_tags(slice_tags: SliceTags) -> bytes:
+    '''
+    ID3 tag of a slice, as stored in the "id3 " chunk of a WAV file
+    '''
+    tags = ID3()
+    tags.add(TALB(encoding=3, text=[slice_tags["album"]]))
+    tags.add(TPE1(encoding=3, text=[slice_tags["artist"]]))
+    tags.add(TPE2(encoding=3, text=[slice_tags["artist"]]))
+    tags.add(TRCK(encoding=3, text=[slice_tags["track"]]))
+    tags.add(TOFN(encoding=3, text=[slice_tags["filename"]]))
+    tags.add(TCON(encoding=3, text=[slice_tags["genre"]]))
+    tags.add(TIT2(encoding=3, text=[slice_tags["title"]]))
+    buffer = io.BytesIO()
+    tags.save(buffer, padding=lambda info: 0)
+    return buffer.getvalue()
 
 
 class MultiSlicer(MultiFileHandler):
-    def __init__(self, data_path: str, verbose: bool = False, pre: float = 200.0, post: float = 0.0) -> None:
+    def __init__(self, data_path: str, verbose: bool = False, pre: float = 200.0, post: float = 0.0, jobs: int = 1, out_format: str = "wav", encode_jobs: int = 4) -> None:
         super().__init__(data_path, verbose, "voice_splits",
-                         "output/slices", None, ["json"])
+                         "output/slices", None, ["json"], jobs=jobs)
         self.extra_ms = pre
         self.earlier_ms = post
+        if out_format not in OUT_FORMATS:
+            raise ValueError(
+                f"Unknown output format '{out_format}'. Available formats: {', '.join(OUT_FORMATS)}")
+        self.out_format = out_format
+        self.encode_jobs = max(1, encode_jobs)
+
+    def dependencies(self, input_file: str) -> List[str]:
+        return [input_file.replace(".json", ".wav").replace("voice_splits", "raw_audio_voices")]
+
+    def params(self) -> Dict[str, Any]:
+        params: Dict[str, Any] = {"pre": self.extra_ms, "post": self.earlier_ms}
+        if self.out_format != "wav":
+            params["out_format"] = self.out_format
+        return params
+
+    def write_slice(self, out_filename: str, audio_file: WavReader, pcm: bytes, tags: SliceTags) -> None:
+        if self.out_format == "wav":
+            write_wav(out_filename, audio_file.fmt, pcm,
+                      [(b"id3 ", id3_tags(tags))])
+            return
+        a = AudioSegment(data=pcm, sample_width=audio_file.sample_width,
+                         frame_rate=audio_file.frame_rate, channels=audio_file.channels)
+        a.export(out_filename, format=self.out_format,
+                 codec=OUT_FORMATS[self.out_format], tags=ffmpeg_tags(tags))
 
-    def handler(self, input_file: str, output_dir: str, file_idx: int) -> None:
-        out_format = "wav"
+    def handler(self, input_file: str, output_dir: str, file_idx: int) -> Dict[str, Any]:
+        out_format = self.out_format
         audio_path = input_file.replace(".json", ".wav").replace(
             "voice_splits", "raw_audio_voices")
         splits = read_split(input_file)
-        audio_file: AudioSegment = AudioSegment.from_wav(audio_path)
-        metadata: MediaInfo = mediainfo(audio_path)
-        for person in splits:
-            out_dir = os.path.join(output_dir, person)
-            os.makedirs(out_dir, exist_ok=True)
-            for split in splits[person]:
-                out_filename = os.path.join(
-                    out_dir, slugify(split["text"])+"."+out_format)
-                t1 = int(split["start"]*1000-self.earlier_ms)
-                t2 = int(split["end"]*1000+self.extra_ms+self.earlier_ms)
-                a: AudioSegment = audio_file[t1:t2]
-                # new_meta = create_metadata(file_idx, person, out_filename, t1, t2, split, metadata)
-
-                a.export(out_filename, format=out_format)
-                set_metadata(out_filename, file_idx, person,
-                             out_filename, t1, t2, split, metadata)
+        audio_file = WavReader(audio_path)
+        # the header is parsed once per source. The result is stored in the manifest and reused while the source is unchanged
+        cached = self.manifest.extra(os.path.relpath(input_file, self.input_dir), audio_path).get(
+            "source") if self.manifest is not None else None
+        metadata = cast(SourceInfo, cached) if cached is not None else probe(audio_file)
+        # Ranges are read here and encoded by the pool. Futures are awaited in order, and a file written
+        # twice (same text) waits for its previous write, so the output does not depend on scheduling
+        pending: "OrderedDict[str, Future[None]]" = OrderedDict()
+        with ThreadPoolExecutor(self.encode_jobs) as pool:
+            for person in splits:
+                out_dir = os.path.join(output_dir, person)
+                os.makedirs(out_dir, exist_ok=True)
+                for split in splits[person]:
+                    out_filename = os.path.join(
+                        out_dir, slugify(split["text"])+"."+out_format)
+                    t1 = int(split["start"]*1000-self.earlier_ms)
+                    t2 = int(split["end"]*1000+self.extra_ms+self.earlier_ms)
+                    # new_meta = create_metadata(file_idx, person, out_filename, t1, t2, split, metadata)
+                    tags = slice_tags(file_idx, person, out_filename,
+                                      t1, t2, split, metadata)
+                    if out_filename in pending:
+                        pending.pop(out_filename).result()
+                    while len(pending) >= 4*self.encode_jobs:
+                        pending.popitem(last=False)[1].result()
+                    pending[out_filename] = pool.submit(
+                        self.write_slice, out_filename, audio_file, audio_file.raw(t1, t2).tobytes(), tags)
+            for future in pending.values():
+                future.result()
+        return {"source": metadata}
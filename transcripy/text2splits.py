@@ -1,10 +1,12 @@
 from genericpath import isfile
+import bisect
 import json
 import math
 import os
-from typing import Dict, List, Union
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union, cast
+import numpy as np
 from colorama import init, Fore, Back, Style
-from .helper import MultiFileHandler, RTTMLine, Segment, read_rttm, read_text
+from .helper import MultiFileHandler, RTTMLine, Segment, WhisperWordSegment, read_rttm, read_text
 from pycaption import DFXPWriter, SAMIWriter, SRTWriter, CaptionList, CaptionSet, Caption, CaptionNode
 from pycaption.transcript import TranscriptWriter
 # Initializes Colorama
@@ -43,37 +45,220 @@ def speaker_style(idx: int) -> str:
     return style
 
 
-def find_nearest_speaker(diarization: List[RTTMLine], start: float, end: float, loss: str = "linear") -> Union[RTTMLine, None]:
-    if len(diarization) == 0:
-        return None
-    if loss == "linear":
-        loss_func = lin
-    else:
-        loss_func = epow
-    losses: List[float] = []
-    filtered_diarization: List[RTTMLine] = []
-    for entry in diarization:
-        if len(losses) == 0:
-            filtered_diarization.append(entry)
-        elif filtered_diarization[-1]["speaker"] != entry["speaker"]:
-            filtered_diarization.append(entry)
+class SpeakerAligner:
+    '''
+    Assigns diarization turns to text segments. Consecutive turns of the same speaker are merged and
+    sorted once, so only the turns close to a segment have to be scored.
+    loss is "linear" or "exponential" (loss of start and end offsets) or "overlap" (longest overlap)
+    '''
+
+    def __init__(self, diarization: List[RTTMLine], loss: str = "linear") -> None:
+        self.method = loss
+        if loss == "exponential":
+            self.loss_func = epow
         else:
-            filtered_diarization[-1]["duration"] = entry["start"] + \
-                entry["duration"]-filtered_diarization[-1]["start"]
-    for entry in filtered_diarization:
-        speaker_start = entry["start"]
-        speaker_end = entry["start"]+entry["duration"]
-        end_loss = loss_func(end-speaker_end)
-        start_loss = loss_func(speaker_start-start)
-        losses.append(2*start_loss+end_loss)
-
-    min_v = losses[0]
-    index = 0
-    for i in range(1, len(losses)):
-        if losses[i] < min_v:
-            min_v = losses[i]
-            index = i
-    return diarization[index]
+            self.loss_func = lin
+        self.turns: List[RTTMLine] = []
+        for entry in sorted(diarization, key=lambda d: d["start"]):
+            if len(self.turns) > 0 and self.turns[-1]["speaker"] == entry["speaker"]:
+                last = self.turns[-1]
+                last["duration"] = max(last["start"]+last["duration"],
+                                       entry["start"]+entry["duration"])-last["start"]
+            else:
+                self.turns.append(
+                    {"start": entry["start"], "duration": entry["duration"], "speaker": entry["speaker"]})
+        self.starts = [t["start"] for t in self.turns]
+        self.ends = [t["start"]+t["duration"] for t in self.turns]
+        # Turns may overlap, so ends are not sorted. max_ends[i] is the latest end of turns 0..i
+        self.max_ends: List[float] = []
+        for e in self.ends:
+            self.max_ends.append(
+                e if len(self.max_ends) == 0 else max(e, self.max_ends[-1]))
+
+    def loss(self, idx: int, start: float, end: float) -> float:
+        start_loss = self.loss_func(self.starts[idx]-start)
+        end_loss = self.loss_func(end-self.ends[idx])
+        return 2*start_loss+end_loss
+
+    def nearest(self, start: float, end: float, first: int) -> int:
+        '''
+        Index of the turn with the lowest loss. first is the index of the first turn starting at or after start.
+        The start loss alone is a lower bound, which grows with the distance to start
+        '''
+        floor = self.loss_func(0)
+        best = math.inf
+        index = -1
+        for i in range(first, len(self.turns)):
+            if 2*self.loss_func(self.starts[i]-start)+floor >= best:
+                break
+            v = self.loss(i, start, end)
+            if v < best:
+                best = v
+                index = i
+        for i in range(first-1, -1, -1):
+            if 2*self.loss_func(self.starts[i]-start)+floor > best:
+                break
+            v = self.loss(i, start, end)
+            if v <= best:
+                best = v
+                index = i
+        return index
+
+    def longest_overlap(self, start: float, end: float) -> int:
+        index = -1
+        best = 0.0
+        i = bisect.bisect_left(self.starts, end)-1
+        while i >= 0 and self.max_ends[i] > start:
+            overlap = min(end, self.ends[i])-max(start, self.starts[i])
+            if overlap >= best and overlap > 0:
+                best = overlap
+                index = i
+            i -= 1
+        return index
+
+    def find(self, start: float, end: float, first: Optional[int] = None) -> Union[RTTMLine, None]:
+        if len(self.turns) == 0:
+            return None
+        index = -1
+        if self.method == "overlap":
+            index = self.longest_overlap(start, end)
+        if index < 0:
+            if first is None:
+                first = bisect.bisect_left(self.starts, start)
+            index = self.nearest(start, end, first)
+        return self.turns[index]
+
+    def align(self, segments: Sequence[Segment]) -> List[Union[RTTMLine, None]]:
+        '''
+        Speaker turn for every segment. Segments are visited by start time, so the search position only moves forward
+        '''
+        result: List[Union[RTTMLine, None]] = [None]*len(segments)
+        order = sorted(range(len(segments)),
+                       key=lambda i: segments[i]["start"])
+        first = 0
+        for i in order:
+            start = segments[i]["start"]
+            while first < len(self.starts) and self.starts[first] < start:
+                first += 1
+            result[i] = self.find(start, segments[i]["end"], first)
+        return result
+
+
+class IncrementalAligner:
+    '''
+    Assigns speakers to the segments of a live transcription while the diarization still grows.
+    A segment is assigned once the turns reach its end, or max_delay seconds of audio after its end.
+    Only turns of the last history seconds before the oldest pending segment are kept
+    '''
+
+    def __init__(self, loss: str = "linear", max_delay: float = 10.0, history: float = 60.0) -> None:
+        self.loss = loss
+        self.max_delay = max_delay
+        self.history = history
+        self.turns: List[RTTMLine] = []
+        self.pending: List[Segment] = []
+        # end of the latest turn, the diarization is complete up to here
+        self.covered = 0.0
+        self.aligner: Optional[SpeakerAligner] = None
+
+    def add_turns(self, turns: List[RTTMLine]) -> None:
+        if len(turns) == 0:
+            return
+        self.turns.extend(turns)
+        self.covered = max(self.covered, max(t["start"]+t["duration"] for t in turns))
+        self.aligner = None
+
+    def push(self, segment: Segment) -> None:
+        self.pending.append(segment)
+
+    def ready(self, now: float, final: bool = False) -> List[Tuple[Segment, Union[RTTMLine, None]]]:
+        '''
+        Pending segments which can be assigned at now seconds of audio, in order. final assigns all of them
+        '''
+        count = 0
+        for segment in self.pending:
+            if not final and segment["end"] > self.covered and now-segment["end"] < self.max_delay:
+                break
+            count += 1
+        if count == 0:
+            return []
+        if self.aligner is None:
+            self.aligner = SpeakerAligner(self.turns, self.loss)
+        result = [(s, self.aligner.find(s["start"], s["end"])) for s in self.pending[:count]]
+        self.pending = self.pending[count:]
+        oldest = self.pending[0]["start"] if len(self.pending) > 0 else now
+        kept = [t for t in self.turns if t["start"]+t["duration"] >= oldest-self.history]
+        if len(kept) < len(self.turns):
+            self.turns = kept
+            self.aligner = None
+        return result
+
+
+def assign_words(word_starts: np.ndarray, word_ends: np.ndarray, turn_starts: np.ndarray, turn_ends: np.ndarray, block_size: int = 2048) -> np.ndarray:
+    '''
+    Index of the turn with the longest overlap for every word, or of the closest turn if no turn overlaps (-1 without turns).
+    turn_starts must be sorted. Words are scored in blocks against the turns around the block, to bound memory
+    '''
+    result = np.full(len(word_starts), -1, dtype=np.int64)
+    num_turns = len(turn_starts)
+    if num_turns == 0 or len(word_starts) == 0:
+        return result
+    order = np.argsort(word_starts, kind="stable")
+    word_starts = word_starts[order]
+    word_ends = word_ends[order]
+    max_ends = np.maximum.accumulate(turn_ends)
+    # index of the turn with the latest end among turns 0..i
+    latest = np.maximum.accumulate(
+        np.where(turn_ends == max_ends, np.arange(num_turns), 0))
+    assigned = np.empty(len(word_starts), dtype=np.int64)
+    for b0 in range(0, len(word_starts), block_size):
+        ws = word_starts[b0:b0+block_size]
+        we = word_ends[b0:b0+block_size]
+        # turns before lo end before the block, turns from hi start after it
+        lo = int(np.searchsorted(max_ends, ws[0], side="right"))
+        hi = int(np.searchsorted(turn_starts, we.max(), side="left"))
+        candidates = [np.arange(lo, hi)]
+        if lo > 0:
+            candidates.insert(0, latest[lo-1:lo])
+        if hi < num_turns:
+            candidates.append(np.array([hi]))
+        candidate = np.concatenate(candidates)
+        # overlap, or the negative gap for disjoint intervals
+        overlap = np.minimum(we[:, None], turn_ends[None, candidate]) - \
+            np.maximum(ws[:, None], turn_starts[None, candidate])
+        assigned[b0:b0+block_size] = candidate[np.argmax(overlap, axis=1)]
+    result[order] = assigned
+    return result
+
+
+def split_words(segments: Sequence[WhisperWordSegment], aligner: SpeakerAligner, block_size: int = 2048) -> Tuple[List[Segment], List[Union[RTTMLine, None]]]:
+    '''
+    Assigns every word to a speaker and regroups runs of words of the same speaker (within a segment) into segments
+    '''
+    words = [(idx, w) for idx, segment in enumerate(segments)
+             for w in segment.get("words", [])]
+    if len(words) == 0:
+        return [], []
+    segment_ids = np.array([idx for idx, _w in words])
+    word_starts = np.array([w["start"] for _idx, w in words], dtype=np.float64)
+    word_ends = np.array([w["end"] for _idx, w in words], dtype=np.float64)
+    turns = assign_words(word_starts, word_ends, np.array(aligner.starts, dtype=np.float64),
+                         np.array(aligner.ends, dtype=np.float64), block_size)
+    boundaries = np.flatnonzero(
+        (np.diff(segment_ids) != 0) | (np.diff(turns) != 0))+1
+    bounds = np.concatenate(([0], boundaries, [len(words)]))
+    new_segments: List[Segment] = []
+    speaker_lines: List[Union[RTTMLine, None]] = []
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        new_segments.append({"start": float(word_starts[a]), "end": float(word_ends[b-1]),
+                             "text": "".join(w["word"] for _idx, w in words[a:b])})
+        speaker_lines.append(
+            aligner.turns[turns[a]] if turns[a] >= 0 else None)
+    return new_segments, speaker_lines
+
+
+def find_nearest_speaker(diarization: List[RTTMLine], start: float, end: float, loss: str = "linear") -> Union[RTTMLine, None]:
+    return SpeakerAligner(diarization, loss).find(start, end)
 
 
 def num2str(v: float) -> str:
@@ -81,10 +266,25 @@ def num2str(v: float) -> str:
 
 
 class MultiVoiceSplitter(MultiFileHandler):
-    def __init__(self, data_path: str, verbose: bool = False, transcribe: bool = False) -> None:
+    def __init__(self, data_path: str, verbose: bool = False, transcribe: bool = False, jobs: int = 1, alignment: str = "linear", word_level: bool = False) -> None:
         super().__init__(data_path, verbose, "raw_audio_voices",
-                         "voice_splits", "json", ignore_existing=transcribe)
+                         "voice_splits", "json", ["wav"], ignore_existing=transcribe, jobs=jobs, manifest=not transcribe)
         self.transcribe = transcribe
+        self.alignment = alignment
+        self.word_level = word_level
+
+    def dependencies(self, input_file: str) -> List[str]:
+        diarization_path = input_file.replace(
+            "raw_audio_voices", "diarization").replace(".wav", ".rttm")
+        text_path = input_file.replace(
+            "raw_audio_voices", "text").replace(".wav", ".json")
+        return [text_path, diarization_path, diarization_path.replace(".rttm", ".json")]
+
+    def params(self) -> Dict[str, Any]:
+        params: Dict[str, Any] = {"alignment": self.alignment}
+        if self.word_level:
+            params["word_level"] = True
+        return params
 
     def handler(self, input_file: str, output_file: str, file_idx: int) -> None:
         diarization_path = input_file.replace(
@@ -93,9 +293,9 @@ class MultiVoiceSplitter(MultiFileHandler):
             "raw_audio_voices", "text").replace(".wav", ".json")
         diarization = []
         if not os.path.isfile(text_path):
-            print(Back.BLACK+Fore.RED +
-                  f"\nWarning!\nNo text '{text_path}' found!.\nRun --audio2text for text-recognition first\n")
-            return
+            # raised, so that the file is not recorded as done
+            raise FileNotFoundError(
+                f"No text '{text_path}' found! Run --audio-to-text for text-recognition first")
         if os.path.isfile(diarization_path):
             _id, diarization = read_rttm(diarization_path)
         else:
@@ -109,11 +309,11 @@ class MultiVoiceSplitter(MultiFileHandler):
         #     # split audio
         #     audio_split = audio
         #     # save audio
-        speakers = []
+        speakers: Dict[str, int] = {}
         if diarization is not None:
             for d in diarization:
                 if d["speaker"] not in speakers:
-                    speakers.append(d["speaker"])
+                    speakers[d["speaker"]] = len(speakers)
         num_speakers = len(speakers)
         num_diaries = len(diarization)
         num_text_segments = len(text["segments"])
@@ -126,14 +326,21 @@ class MultiVoiceSplitter(MultiFileHandler):
         splits: Dict[str, List[Segment]] = {}
         last_speaker = ""
         captions: List[Caption] = []
-        for segment in text["segments"]:
+        aligner = SpeakerAligner(diarization, self.alignment)
+        segments: Sequence[Segment] = text["segments"]
+        if self.word_level and any("words" in s for s in text["segments"]):
+            segments, speaker_lines = split_words(
+                cast(List[WhisperWordSegment], text["segments"]), aligner)
+        else:
+            if self.word_level:
+                print(Back.BLACK+Fore.RED +
+                      f"\nWarning!\nNo word timestamps in '{text_path}'.\nRun --audio-to-text with --word-timestamps first\n")
+            speaker_lines = aligner.align(segments)
+        for segment, speaker_line in zip(segments, speaker_lines):
             speaker = ""
-            speaker_line = find_nearest_speaker(
-                diarization, segment["start"], segment["end"])
             if speaker_line is not None:
                 speaker = speaker_line["speaker"]
-                speaker_color = speaker_style(
-                    speakers.index(speaker))
+                speaker_color = speaker_style(speakers[speaker])
                 end = max(segment["end"], speaker_line["start"] +
                           speaker_line["duration"])
                 start = max(segment["start"], speaker_line["start"])
@@ -1,80 +1,100 @@
 import plotly.graph_objects as go
 import os
+from functools import lru_cache
 from typing import Dict, List, Optional, Tuple
-from .helper import MultiFileHandler, RTTMLine, Segment, TextObject, read_rttm, read_split, read_text
-from pydub import AudioSegment
+from .helper import MultiFileHandler, RTTMLine, Segment, TextObject, WavReader, pcm_to_float, read_rttm, read_split, read_text
 from plotly.subplots import make_subplots
 from plotly.graph_objects import Scatter
 import numpy as np
 from colour import Color
 
 
+@lru_cache(maxsize=None)
+def gradient(steps: int = 101) -> List[str]:
+    return [c.get_hex() for c in Color("blue").range_to("red", steps)]
+
+
 def perc_c(v: float) -> str:
-    color: str = list(Color("blue").range_to("red", 101))[int(v*100)].get_hex()
-    return color
+    return gradient()[int(v*100)]
 
 
-def pydub_to_np(audio: AudioSegment) -> Tuple[np.ndarray, np.ndarray]:
+def wav_envelope(audio: WavReader, bins: int = 4000, block_frames: int = 1 << 20) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Converts pydub audio segment into np.float32 of shape [duration_in_seconds*sample_rate, channels],
-    where each value is in range [-1.0, 1.0]. 
-    Returns tuple (audio_np_array, sample_rate).
+    Min/max envelope of a WAV file with at most bins pairs of (min, max) values per channel, so that peaks are kept.
+    The file is read in blocks of block_frames frames.
+    Returns tuple (times, audio_np_array) with values in range [-1.0, 1.0] of shape [points, channels].
     """
-    channels = audio.channels
-    sample_width = audio.sample_width
-    frame_rate = audio.frame_rate
-    assert channels is not None
-    assert frame_rate is not None
-    assert sample_width is not None
-    y = np.array(audio.get_array_of_samples(), dtype=np.float32).reshape((-1, channels)) / (
-        1 << (8 * sample_width - 1))
-    t_max = len(y) / frame_rate
-    x = np.linspace(start=0, stop=t_max, num=len(y))
-    return x, y
+    step = max(1, -(-audio.frames//bins))
+    if step <= 2:
+        y = pcm_to_float(audio.frame_samples(0, audio.frames), audio.sample_width)
+        return np.arange(len(y))/audio.frame_rate, y
+    n = -(-audio.frames//step)
+    block = max(1, block_frames//step)*step
+    y = np.empty((n, 2, audio.channels), dtype=np.float32)
+    for f1 in range(0, audio.frames, block):
+        samples = pcm_to_float(audio.frame_samples(f1, min(f1+block, audio.frames)), audio.sample_width)
+        full = len(samples)//step
+        i = f1//step
+        if full > 0:
+            chunks = samples[:full*step].reshape((full, step, audio.channels))
+            y[i:i+full, 0] = chunks.min(axis=1)
+            y[i:i+full, 1] = chunks.max(axis=1)
+        if len(samples) > full*step:
+            y[i+full, 0] = samples[full*step:].min(axis=0)
+            y[i+full, 1] = samples[full*step:].max(axis=0)
+    x = np.repeat(np.arange(n)*step/audio.frame_rate, 2)
+    return x, y.reshape((2*n, audio.channels))
 
 
-def plot_rect(x0: float, x1: float, y0: float, y1: float, fillcolor: str, showlegend: bool = True, name: str = "", legend: Optional[str] = None) -> Tuple[Scatter, Scatter]:
-    x_pos = x0+(x1-x0)/2
-    y_pos = (y1-y0)/2
-    if legend is None:
-        legend = name
+def plot_rects(x0: np.ndarray, x1: np.ndarray, y0: float, y1: float, fillcolor: str, names: List[str], legend: str, showlegend: bool = True, labels: bool = True) -> List[Scatter]:
+    """
+    All rectangles of one color as a single trace, separated by gaps.
+    The names are shown on hover and, if labels, in the center of each rectangle
+    """
+    nan = np.full_like(x0, np.nan)
+    x = np.column_stack([x0, x1, x1, x0, x0, nan]).ravel()
+    y = np.tile([y0, y0, y1, y1, y0, np.nan], len(x0))
     box = go.Scatter(
-        x=[x0, x1, x1, x0, x0],
-        y=[y0, y0, y1, y1, y0],
+        x=x,
+        y=y,
         mode='lines',
-        name=name,
-        meta=[name],
-        hovertemplate='%{meta[0]}<extra></extra>',
+        name=legend,
+        text=np.repeat(names, 6),
+        hovertemplate='%{text}<extra></extra>',
         legendgroup=legend,
         line=dict(color="black"),
         fill='toself',
         fillcolor=fillcolor,
         showlegend=showlegend
     )
-
-    # add the text in the center of each rectangle
+    if not labels:
+        return [box]
     # skip hoverinfo since the rectangle itself already has hoverinfo
     label = go.Scatter(
-        x=[x_pos],
-        y=[y_pos],
+        x=(x0+x1)/2,
+        y=np.full_like(x0, (y1-y0)/2),
         mode='text',
         legendgroup=legend,
-        text=[name],
+        text=names,
         hoverinfo='skip',
         textposition="middle center",
         showlegend=False
     )
-    return box, label
-
-
-# create our callback function
-def split_clicked(trace, points, selector):
-    print(trace, points, selector)
+    return [box, label]
 
 
 class MultiViewer(MultiFileHandler):
-    def __init__(self, data_path: str, verbose: bool = False):
-        super().__init__(data_path, verbose, "raw_audio_voices",  "output/analysis", "html")
+    def __init__(self, data_path: str, verbose: bool = False, jobs: int = 1):
+        super().__init__(data_path, verbose, "raw_audio_voices",  "output/analysis", "html", jobs=jobs)
+        # width of the figure in pixels, the waveform is decimated to a (min, max) pair per pixel
+        self.width = 1900
+
+    def dependencies(self, input_file: str) -> List[str]:
+        diarization_path = input_file.replace(
+            "raw_audio_voices", "diarization").replace(".wav", ".rttm")
+        return [diarization_path, diarization_path.replace(".rttm", ".json"),
+                input_file.replace("raw_audio_voices", "text").replace(".wav", ".json"),
+                input_file.replace("raw_audio_voices", "voice_splits").replace(".wav", ".json")]
 
     def handler(self, input_file: str, output_file: str, file_idx: int) -> None:
         diarization_path = input_file.replace(
@@ -90,13 +110,13 @@ class MultiViewer(MultiFileHandler):
         if os.path.isfile(diarization_path):
             _id, diarization = read_rttm(diarization_path)
             rows += 1
-        if os.path.isfile(diarization_path):
+        if os.path.isfile(text_path):
             text = read_text(text_path)
             rows += 1
         if os.path.isfile(split_path):
             splits = read_split(split_path)
             rows += 1
-        audio_file: AudioSegment = AudioSegment.from_wav(input_file)
+        audio_file = WavReader(input_file)
         # speakers = []
         # for d in diarization:
         #     if d["speaker"] not in speakers:
@@ -111,88 +131,51 @@ class MultiViewer(MultiFileHandler):
         fig = make_subplots(rows=rows, cols=1,
                             shared_xaxes=True,
                             vertical_spacing=0.02)
-        audio_x, audio_y = pydub_to_np(audio_file)
-        audio_subsampling = 20
-        for channel in range(len(audio_y[1])):
-            fig.add_trace(go.Scatter(x=audio_x[1::audio_subsampling], y=audio_y[:, channel]
-                          [1::audio_subsampling], name=f'Channel {channel+1}'), row=row, col=1)
+        audio_x, audio_y = wav_envelope(audio_file, self.width)
+        for channel in range(audio_file.channels):
+            fig.add_trace(go.Scatter(x=audio_x, y=audio_y[:, channel],
+                                     name=f'Channel {channel+1}'), row=row, col=1)
         row += 1
 
-        speakers = []
+        speakers: List[str] = []
         if diarization is not None:
             for d in diarization:
                 if d["speaker"] not in speakers:
                     speakers.append(d["speaker"])
-            for diary in diarization:
-                y0 = 0
-                y1 = 1
-                x0 = diary["start"]
-                x1 = x0+diary["duration"]
-                # fig.add_shape(type="rect",
-                #               x0=x0, y0=y0, x1=x1, y1=y1, name=diary["speaker"],
-                #               #   line=dict(
-                #               #       color="RoyalBlue",
-                #               #       width=2,
-                #               #   ),
-                #               fillcolor=perc_c(speakers.index(
-                #                   diary["speaker"])/len(speakers)),
-                #               row=row, col=1
-                #               ).update_layout(yaxis_title="Diarization")
-                box, label = plot_rect(x0=x0, y0=y0, x1=x1, y1=y1, name=diary["speaker"],
-                                       fillcolor=perc_c(speakers.index(
-                                           diary["speaker"])/len(speakers)))
-                fig.add_trace(box, row=row, col=1)
-                fig.add_trace(label, row=row, col=1)
+        if splits is not None:
+            for speaker in splits:
+                if speaker not in speakers:
+                    speakers.append(speaker)
+        if diarization is not None:
+            by_speaker: Dict[str, List[RTTMLine]] = {}
+            for d in diarization:
+                by_speaker.setdefault(d["speaker"], []).append(d)
+            for speaker, diaries in by_speaker.items():
+                x0 = np.array([d["start"] for d in diaries])
+                x1 = x0+np.array([d["duration"] for d in diaries])
+                for trace in plot_rects(x0, x1, 0, 1, perc_c(speakers.index(speaker)/len(speakers)),
+                                        [speaker]*len(diaries), legend=speaker):
+                    fig.add_trace(trace, row=row, col=1)
             row += 1
         if text is not None:
-            # fig.add_trace(go.Scatter(x=[2, 3, 4], y=[100, 110, 120], name="Text"),
-            #               row=row, col=1).update_layout(yaxis_title="Text")
-            for segment in text["segments"]:
-                y0 = 0
-                y1 = 1
-                x0 = segment["start"]
-                x1 = segment["end"]
-                # fig.add_shape(type="rect",
-                #               x0=x0, y0=y0, x1=x1, y1=y1, name=segment["text"],
-                #               #   line=dict(
-                #               #       color="RoyalBlue",
-                #               #       width=2,
-                #               #   ),
-                #               fillcolor="RoyalBlue",
-                #               row=row, col=1
-                #               ).update_layout(yaxis_title="Text")
-                box, label = plot_rect(x0=x0, y0=y0, x1=x1, y1=y1, name=segment["text"],
-                                       fillcolor="RoyalBlue")
-                fig.add_trace(box, row=row, col=1)
-                fig.add_trace(label, row=row, col=1)
+            segments = text["segments"]
+            if len(segments) > 0:
+                for trace in plot_rects(np.array([s["start"] for s in segments]), np.array([s["end"] for s in segments]), 0, 1,
+                                        "RoyalBlue", [s["text"] for s in segments], legend="Text"):
+                    fig.add_trace(trace, row=row, col=1)
             row += 1
         if splits is not None:
-            # fig.add_trace(go.Scatter(x=[3, 4, 5], y=[1000, 1100, 1200], name="Splits", xaxis=""),
-            #               row=row, col=1).update_layout(yaxis_title="Splits", xaxis_title="Zeit [s]")
             for speaker in splits:
-                for line in splits[speaker]:
-                    y0 = 0
-                    y1 = 1
-                    x0 = line["start"]
-                    x1 = line["end"]
-                    # fig.add_shape(type="rect",
-                    #               x0=x0, y0=y0, x1=x1, y1=y1, name=line["text"],
-                    #               #   line=dict(
-                    #               #       color="RoyalBlue",
-                    #               #       width=2,
-                    #               #   ),
-                    #               fillcolor=perc_c(speakers.index(
-                    #                   speaker)/len(speakers)),
-                    #               row=row, col=1
-                    #               ).update_layout(yaxis_title="Splits")
-                    box, label = plot_rect(x0=x0, y0=y0, x1=x1, y1=y1, name=line["text"],
-                                           fillcolor=perc_c(speakers.index(
-                                               speaker)/len(speakers)), legend=speaker)
-                    fig.add_trace(box, row=row, col=1)
-                    fig.add_trace(label, row=row, col=1)
-                    # box.on_click(split_clicked)
+                lines = splits[speaker]
+                if len(lines) == 0:
+                    continue
+                # the legend entry of the speaker is shown by the diarization already
+                for trace in plot_rects(np.array([l["start"] for l in lines]), np.array([l["end"] for l in lines]), 0, 1,
+                                        perc_c(speakers.index(speaker)/len(speakers)), [l["text"] for l in lines],
+                                        legend=speaker, showlegend=diarization is None):
+                    fig.add_trace(trace, row=row, col=1)
             row += 1
-        fig.update_layout(height=1000, width=1900,
+        fig.update_layout(height=1000, width=self.width,
                           title_text=f"Datei {input_file}",
                           yaxis_title="Wert",
                           legend_title="Legende",)
@@ -0,0 +1,288 @@
+import html
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from typing import Any, Dict, Optional
+from urllib.parse import parse_qs, quote, urlparse
+
+from .helper import WavReader, read_rttm, read_split, read_text, wav_bytes
+from .wavePeaks import MultiPeakBuilder, PeakPyramid
+
+# longest range streamed for a clicked segment
+MAX_AUDIO_SECONDS = 600
+
+VIEWER_PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>transcripy - {title}</title>
+<style>
+body {{ font-family: sans-serif; margin: 0; }}
+#bar {{ padding: 6px; }}
+canvas {{ display: block; cursor: crosshair; }}
+</style>
+</head>
+<body>
+<div id="bar"><b>{title}</b> <span id="range"></span> <span id="hover"></span></div>
+<canvas id="canvas"></canvas>
+<script>
+const file = {file};
+const WAVE = 240, ROW = 40, GAP = 6;
+const canvas = document.getElementById("canvas"), ctx = canvas.getContext("2d");
+const tiles = new Map();
+let info = null, view = {{start: 0, end: 1}}, rows = [], hits = [], audio = null, drag = null;
+
+function api(path, params) {{
+  return "api/" + path + "?file=" + encodeURIComponent(file) + Object.entries(params || {{}}).map(([k, v]) => "&" + k + "=" + v).join("");
+}}
+// blue to red, like perc_c of the static viewer
+function speakerColor(speaker) {{
+  const i = info.speakers.indexOf(speaker);
+  return "hsl(" + (240 - 240 * i / Math.max(1, info.speakers.length)) + ", 70%, 60%)";
+}}
+function tile(level, index) {{
+  const key = level + "/" + index;
+  if (!tiles.has(key)) {{
+    tiles.set(key, null);
+    fetch(api("tile", {{level: level, index: index}})).then(r => r.arrayBuffer()).then(b => {{
+      tiles.set(key, new Int16Array(b));
+      draw();
+    }});
+  }}
+  return tiles.get(key);
+}}
+function secondsPerPixel() {{ return (view.end - view.start) / canvas.width; }}
+function toX(t) {{ return (t - view.start) / secondsPerPixel(); }}
+function level() {{
+  // the coarsest level with at least one bin per pixel
+  const framesPerPixel = secondsPerPixel() * info.peaks.frame_rate, levels = info.peaks.levels;
+  let l = 0;
+  while (l + 1 < levels.length && levels[l + 1].frames_per_bin <= framesPerPixel) l++;
+  return l;
+}}
+function drawWave() {{
+  const p = info.peaks, l = level(), lv = p.levels[l], tb = p.tile_bins, channels = p.channels;
+  const b1 = Math.max(0, Math.floor(view.start * p.frame_rate / lv.frames_per_bin));
+  const b2 = Math.min(lv.bins, Math.ceil(view.end * p.frame_rate / lv.frames_per_bin));
+  const h = WAVE / channels, scale = h / 2 / 32767, w = Math.max(1, lv.frames_per_bin / p.frame_rate / secondsPerPixel());
+  for (let t = Math.floor(b1 / tb); t <= Math.floor((b2 - 1) / tb); t++) {{
+    const d = tile(l, t);
+    if (!d) continue;
+    for (let j = 0; j < d.length / (3 * channels); j++) {{
+      const b = t * tb + j;
+      if (b < b1 || b >= b2) continue;
+      const x = toX(b * lv.frames_per_bin / p.frame_rate);
+      for (let c = 0; c < channels; c++) {{
+        const o = (j * channels + c) * 3, mid = h * c + h / 2;
+        ctx.fillStyle = "#4a6fd1";
+        ctx.fillRect(x, mid - d[o + 1] * scale, w, Math.max(1, (d[o + 1] - d[o]) * scale));
+        ctx.fillStyle = "#9db4f0";
+        ctx.fillRect(x, mid - d[o + 2] * scale, w, Math.max(1, 2 * d[o + 2] * scale));
+      }}
+    }}
+  }}
+}}
+function drawRow(idx, row) {{
+  const y = WAVE + GAP + idx * (ROW + GAP);
+  ctx.fillStyle = "#eee";
+  ctx.fillRect(0, y, canvas.width, ROW);
+  for (const s of row.segments) {{
+    if (s.end < view.start || s.start > view.end) continue;
+    const x0 = toX(s.start), x1 = toX(s.end);
+    ctx.fillStyle = s.color;
+    ctx.fillRect(x0, y, Math.max(1, x1 - x0), ROW);
+    ctx.strokeStyle = "black";
+    ctx.strokeRect(x0, y, Math.max(1, x1 - x0), ROW);
+    if (x1 - x0 > 30) {{
+      ctx.save();
+      ctx.beginPath();
+      ctx.rect(x0, y, x1 - x0, ROW);
+      ctx.clip();
+      ctx.fillStyle = "black";
+      ctx.fillText(s.label, x0 + 3, y + ROW / 2 + 4);
+      ctx.restore();
+    }}
+    hits.push({{x0: x0, x1: x1, y0: y, y1: y + ROW, segment: s}});
+  }}
+}}
+function draw() {{
+  if (!info) return;
+  ctx.clearRect(0, 0, canvas.width, canvas.height);
+  hits = [];
+  drawWave();
+  rows.forEach((row, idx) => drawRow(idx, row));
+  document.getElementById("range").textContent = view.start.toFixed(2) + "s - " + view.end.toFixed(2) + "s";
+}}
+function resize() {{
+  canvas.width = window.innerWidth;
+  canvas.height = WAVE + rows.length * (ROW + GAP) + GAP;
+  draw();
+}}
+function hit(e) {{
+  const r = canvas.getBoundingClientRect(), x = e.clientX - r.left, y = e.clientY - r.top;
+  return hits.find(h => x >= h.x0 && x <= h.x1 && y >= h.y0 && y <= h.y1);
+}}
+function play(segment) {{
+  if (audio) audio.pause();
+  audio = new Audio(api("audio", {{start: segment.start, end: segment.end}}));
+  audio.play();
+}}
+canvas.addEventListener("wheel", e => {{
+  e.preventDefault();
+  const t = view.start + (e.clientX - canvas.getBoundingClientRect().left) * secondsPerPixel();
+  const f = e.deltaY > 0 ? 1.25 : 0.8, duration = Math.min(info.duration, Math.max(0.05, (view.end - view.start) * f));
+  view.start = Math.min(Math.max(0, t - (t - view.start) * duration / (view.end - view.start)), info.duration - duration);
+  view.end = view.start + duration;
+  draw();
+}});
+canvas.addEventListener("mousedown", e => {{ drag = {{x: e.clientX, start: view.start, moved: false}}; }});
+window.addEventListener("mouseup", e => {{
+  if (drag && !drag.moved) {{
+    const h = hit(e);
+    if (h) play(h.segment);
+  }}
+  drag = null;
+}});
+canvas.addEventListener("mousemove", e => {{
+  if (drag) {{
+    const dx = e.clientX - drag.x, duration = view.end - view.start;
+    drag.moved = drag.moved || Math.abs(dx) > 3;
+    view.start = Math.min(Math.max(0, drag.start - dx * secondsPerPixel()), info.duration - duration);
+    view.end = view.start + duration;
+    draw();
+  }}
+  const h = hit(e);
+  document.getElementById("hover").textContent = h ? "| " + h.segment.label + " (" + h.segment.start.toFixed(2) + "s)" : "";
+}});
+window.addEventListener("resize", resize);
+fetch(api("info")).then(r => r.json()).then(data => {{
+  info = data;
+  view = {{start: 0, end: info.duration}};
+  if (info.diarization) rows.push({{segments: info.diarization.map(d => ({{start: d.start, end: d.start + d.duration, label: d.speaker, color: speakerColor(d.speaker)}}))}});
+  if (info.text) rows.push({{segments: info.text.map(s => ({{start: s.start, end: s.end, label: s.text, color: "RoyalBlue"}}))}});
+  if (info.splits) rows.push({{segments: Object.entries(info.splits).flatMap(([speaker, lines]) => lines.map(l => ({{start: l.start, end: l.end, label: speaker + ": " + l.text, color: speakerColor(speaker)}})))}});
+  resize();
+}});
+</script>
+</body>
+</html>
+'''
+
+
+class ViewerServer:
+    '''
+    Local HTTP viewer of the files in raw_audio_voices. The page fetches peak tiles of the visible range only
+    and streams the audio of a clicked segment
+    '''
+
+    def __init__(self, data_path: str, verbose: bool = False, port: int = 8000, jobs: int = 1) -> None:
+        self.data_path = data_path
+        self.verbose = verbose
+        self.port = port
+        self.peak_builder = MultiPeakBuilder(data_path, verbose=verbose, jobs=jobs)
+        self.pyramids: Dict[str, PeakPyramid] = {}
+        self.readers: Dict[str, WavReader] = {}
+        self.lock = Lock()
+
+    def input_file(self, file: str) -> str:
+        if file not in self.peak_builder.files:
+            raise KeyError(file)
+        return os.path.join(self.peak_builder.input_dir, file)
+
+    def pyramid(self, file: str) -> PeakPyramid:
+        with self.lock:
+            if file not in self.pyramids:
+                self.input_file(file)
+                self.pyramids[file] = PeakPyramid(self.peak_builder.output_path(file))
+            return self.pyramids[file]
+
+    def reader(self, file: str) -> WavReader:
+        with self.lock:
+            if file not in self.readers:
+                self.readers[file] = WavReader(self.input_file(file))
+            return self.readers[file]
+
+    def info(self, file: str) -> Dict[str, Any]:
+        input_file = self.input_file(file)
+        diarization_path = input_file.replace(
+            "raw_audio_voices", "diarization").replace(".wav", ".rttm")
+        text_path = input_file.replace(
+            "raw_audio_voices", "text").replace(".wav", ".json")
+        split_path = input_file.replace(
+            "raw_audio_voices", "voice_splits").replace(".wav", ".json")
+        pyramid = self.pyramid(file)
+        info: Dict[str, Any] = {"peaks": pyramid.info, "duration": pyramid.info["frames"]/pyramid.info["frame_rate"],
+                                "diarization": None, "text": None, "splits": None}
+        speakers = []
+        if os.path.isfile(diarization_path):
+            _id, info["diarization"] = read_rttm(diarization_path)
+            speakers.extend(d["speaker"] for d in info["diarization"])
+        if os.path.isfile(text_path):
+            info["text"] = read_text(text_path)["segments"]
+        if os.path.isfile(split_path):
+            info["splits"] = read_split(split_path)
+            speakers.extend(info["splits"])
+        info["speakers"] = list(dict.fromkeys(speakers))
+        return info
+
+    def audio(self, file: str, start: float, end: float) -> bytes:
+        reader = self.reader(file)
+        end = min(end, start+MAX_AUDIO_SECONDS)
+        return wav_bytes(reader.fmt, reader.raw(start*1000, end*1000).tobytes())
+
+    def index(self) -> str:
+        links = "".join(
+            f'<li><a href="view?file={quote(file)}">{html.escape(file)}</a></li>' for file in self.peak_builder.files)
+        return f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>transcripy</title></head><body><ul>{links}</ul></body></html>'
+
+    def page(self, file: str) -> str:
+        self.input_file(file)
+        return VIEWER_PAGE.format(title=html.escape(file), file=json.dumps(file))
+
+    def run(self) -> None:
+        self.peak_builder.run()
+        server = ThreadingHTTPServer(("127.0.0.1", self.port), ViewerRequestHandler)
+        server.viewer = self  # type: ignore
+        print(f"Viewer running on http://127.0.0.1:{self.port}/ (Ctrl+C to stop)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+class ViewerRequestHandler(BaseHTTPRequestHandler):
+    def send(self, content_type: str, body: bytes) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        viewer: ViewerServer = self.server.viewer  # type: ignore
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        file: Optional[str] = query.get("file")
+        try:
+            if url.path == "/":
+                self.send("text/html; charset=utf-8", viewer.index().encode("utf-8"))
+            elif url.path == "/view" and file is not None:
+                self.send("text/html; charset=utf-8", viewer.page(file).encode("utf-8"))
+            elif url.path == "/api/info" and file is not None:
+                self.send("application/json", json.dumps(viewer.info(file)).encode("utf-8"))
+            elif url.path == "/api/tile" and file is not None:
+                tile = viewer.pyramid(file).tile(int(query["level"]), int(query["index"]))
+                self.send("application/octet-stream", tile.astype("<i2").tobytes())
+            elif url.path == "/api/audio" and file is not None:
+                self.send("audio/wav", viewer.audio(file, float(query["start"]), float(query["end"])))
+            else:
+                self.send_error(404)
+        except (KeyError, IndexError, ValueError):
+            self.send_error(400)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if self.server.viewer.verbose:  # type: ignore
+            super().log_message(format, *args)
@@ -0,0 +1,123 @@
+import json
+import os
+from typing import Dict, List, TypedDict
+
+import numpy as np
+
+from .helper import MultiFileHandler, WavReader, pcm_to_float
+
+# frames summarized by one bin of the finest level
+BASE_BINS = 256
+# bins of a level summarized by one bin of the next level
+LEVEL_FACTOR = 4
+# bins per tile, the coarsest level fits into one tile
+TILE_BINS = 1024
+# peaks are stored as int16 of range [-1.0, 1.0]
+PEAK_SCALE = 32767
+MIN, MAX, RMS = 0, 1, 2
+
+
+class PeakLevel(TypedDict):
+    offset: int
+    bins: int
+    frames_per_bin: int
+
+
+class PeakInfo(TypedDict):
+    frame_rate: int
+    channels: int
+    frames: int
+    tile_bins: int
+    levels: List[PeakLevel]
+
+
+def peak_levels(frames: int, base: int = BASE_BINS, factor: int = LEVEL_FACTOR, tile_bins: int = TILE_BINS) -> List[PeakLevel]:
+    levels: List[PeakLevel] = []
+    offset = 0
+    frames_per_bin = base
+    while True:
+        bins = max(1, -(-frames//frames_per_bin))
+        levels.append({"offset": offset, "bins": bins, "frames_per_bin": frames_per_bin})
+        offset += bins
+        if bins <= tile_bins:
+            return levels
+        frames_per_bin *= factor
+
+
+def build_peaks(audio: WavReader, npy_path: str, json_path: str, block_bins: int = 4096) -> PeakInfo:
+    '''
+    Writes the min/max/RMS pyramid of a WAV file into a .npy file of shape [bins, channels, 3] (all levels concatenated)
+    and its levels into a .json file. The file is read in blocks of block_bins bins of the finest level
+    '''
+    levels = peak_levels(audio.frames)
+    total = levels[-1]["offset"]+levels[-1]["bins"]
+    peaks = np.lib.format.open_memmap(npy_path, mode="w+", dtype="<i2", shape=(total, audio.channels, 3))
+    base = levels[0]["frames_per_bin"]
+    # squared RMS of every bin, to combine them into the next level
+    power = np.zeros((levels[0]["bins"], audio.channels), dtype=np.float32)
+    block = block_bins*base
+    for f1 in range(0, audio.frames, block):
+        samples = pcm_to_float(audio.frame_samples(f1, min(f1+block, audio.frames)), audio.sample_width)
+        bins = -(-len(samples)//base)
+        padded = np.zeros((bins*base, audio.channels), dtype=np.float32)
+        padded[:len(samples)] = samples
+        chunks = padded.reshape((bins, base, audio.channels))
+        i = f1//base
+        summary = np.empty((bins, audio.channels, 3), dtype=np.float32)
+        summary[:, :, MIN] = chunks.min(axis=1)
+        summary[:, :, MAX] = chunks.max(axis=1)
+        # the padding of the last bin is not part of the mean
+        counts = np.minimum(base, len(samples)-np.arange(bins)*base)[:, None]
+        power[i:i+bins] = np.square(chunks).sum(axis=1)/counts
+        summary[:, :, RMS] = np.sqrt(power[i:i+bins])
+        peaks[i:i+bins] = np.round(summary*PEAK_SCALE)
+    for previous, level in zip(levels[:-1], levels[1:]):
+        src = peaks[previous["offset"]:previous["offset"]+previous["bins"]].astype(np.int32)
+        pad = level["bins"]*LEVEL_FACTOR-previous["bins"]
+        groups = np.concatenate([src, np.repeat(src[-1:], pad, axis=0)]).reshape(
+            (level["bins"], LEVEL_FACTOR, audio.channels, 3))
+        power = np.concatenate([power, np.repeat(power[-1:], pad, axis=0)]).reshape(
+            (level["bins"], LEVEL_FACTOR, audio.channels)).mean(axis=1)
+        dst = peaks[level["offset"]:level["offset"]+level["bins"]]
+        dst[:, :, MIN] = groups[:, :, :, MIN].min(axis=1)
+        dst[:, :, MAX] = groups[:, :, :, MAX].max(axis=1)
+        dst[:, :, RMS] = np.round(np.sqrt(power)*PEAK_SCALE)
+    peaks.flush()
+    del peaks
+    info: PeakInfo = {"frame_rate": audio.frame_rate, "channels": audio.channels,
+                      "frames": audio.frames, "tile_bins": TILE_BINS, "levels": levels}
+    with open(json_path, "w") as f:
+        json.dump(info, f, indent=2)
+    return info
+
+
+class PeakPyramid:
+    '''
+    Memory-mapped peaks of a WAV file written by build_peaks
+    '''
+
+    def __init__(self, npy_path: str) -> None:
+        with open(os.path.splitext(npy_path)[0]+".json", "r") as f:
+            self.info: PeakInfo = json.load(f)
+        self.peaks = np.load(npy_path, mmap_mode="r")
+
+    def tile(self, level: int, index: int) -> np.ndarray:
+        '''
+        Bins [index*tile_bins, (index+1)*tile_bins) of a level with shape [bins, channels, 3]
+        '''
+        l = self.info["levels"][level]
+        t1 = min(index*self.info["tile_bins"], l["bins"])
+        t2 = min(t1+self.info["tile_bins"], l["bins"])
+        return self.peaks[l["offset"]+t1:l["offset"]+t2]
+
+
+class MultiPeakBuilder(MultiFileHandler):
+    def __init__(self, data_path: str, verbose: bool = False, jobs: int = 1):
+        super().__init__(data_path, verbose, "raw_audio_voices", "output/peaks", "npy", ["wav"], jobs=jobs)
+
+    def params(self) -> Dict[str, int]:
+        return {"base": BASE_BINS, "factor": LEVEL_FACTOR, "tile": TILE_BINS}
+
+    def handler(self, input_file: str, output_file: str, file_idx: int) -> None:
+        build_peaks(WavReader(input_file), output_file, os.path.splitext(output_file)[0]+".json")
+